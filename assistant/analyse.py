@@ -1,10 +1,13 @@
 import ast
 import pandas as pd
 from jinja2 import Template
-from assistant.llm import num_tokens_from_string
+from assistant import tokens
+from assistant.concurrency import run_concurrently, containers
 import json
 
 MAX_TOKENS = 5000
+# Tokens of the JSON quotes and separator around each review in the prompt
+REVIEW_TOKEN_OVERHEAD = 2
 
 
 def sql_query(queries, gpt):
@@ -42,49 +45,76 @@ def review_text(df_reviews, gpt):
     return analysis
 
 
-def plots(plots, companies, gpt):
+def plots(plots, companies, gpt, concurrent=True):
+    """
+    Render every figure at once, each in its own container, and stream the
+    analysis of each plot into its container under the figure.
+
+    With `concurrent` the plots are analysed at the same time, each with its own
+    context. Otherwise they are analysed one after the other in one
+    conversation, so each analysis sees the previous ones.
+    """
     company_descr = (
         f"comany: {companies[0]}" if len(companies) == 1 else f"companies: {companies}"
     )
     sys_msg = PLOT_ANALYSIS_SYS_MSG.render(company=company_descr, question=gpt.question)
-    messages = [dict(role="system", content=sys_msg)]
+    plot_containers = containers(gpt.st, len(plots))
+    for plot, container in zip(plots, plot_containers):
+        if container is not None:
+            container.plotly_chart(plot["fig"], use_container_width=True)
+
+    if concurrent:
+        analyses = run_concurrently(
+            [
+                (
+                    plot_analysis,
+                    [
+                        dict(role="system", content=sys_msg),
+                        dict(role="user", content=plot_user_msg(plot)),
+                    ],
+                    gpt.with_st(container),
+                )
+                for plot, container in zip(plots, plot_containers)
+            ]
+        )
+    else:
+        messages = [dict(role="system", content=sys_msg)]
+        analyses = []
+        for plot, container in zip(plots, plot_containers):
+            messages.append(dict(role="user", content=plot_user_msg(plot)))
+            analysis = plot_analysis(messages, gpt.with_st(container))
+            messages.append(dict(role="assistant", content=analysis))
+            analyses.append(analysis)
+
     analysis_msgs = []
-    for plot in plots:
-        fig, data, plot_descr = plot["fig"], plot["data"], plot["descr"]
-
-        if type(data) == dict:
-            user_msg = f"Data visualisation description: {plot_descr}\n\n"
-            for company, df in data.items():
-                user_msg += f"Company: {company}\n{df.to_csv(index=False)}\n\n"
-        else:
-            user_msg = PLOT_ANALYSIS_USER_MSG.render(
-                plot_descr=plot_descr, data=data.to_csv(index=False)
-            )
-        messages.append(dict(role="user", content=user_msg))
+    for plot, analysis in zip(plots, analyses):
+        analysis_msgs.append(dict(role="plot", content=plot["fig"]))
+        analysis_msgs.append(dict(role="assistant", content=analysis))
+    return analysis_msgs
 
-        gpt.st.plotly_chart(fig, use_container_width=True)
-        analysis = gpt.completion(
-            messages=messages, model="gpt-4", name="Plot", kind="llm"
-        )
 
-        messages.append(dict(role="assistant", content=analysis))
+def plot_analysis(messages, gpt) -> str:
+    return gpt.completion(messages=messages, model="gpt-4", name="Plot", kind="llm")
 
-        analysis_msgs.append(dict(role="plot", content=fig))
-        analysis_msgs.append(dict(role="assistant", content=analysis))
 
-    return analysis_msgs
+def plot_user_msg(plot) -> str:
+    data, plot_descr = plot["data"], plot["descr"]
+    if type(data) == dict:
+        user_msg = f"Data visualisation description: {plot_descr}\n\n"
+        for company, df in data.items():
+            user_msg += f"Company: {company}\n{df.to_csv(index=False)}\n\n"
+    else:
+        user_msg = PLOT_ANALYSIS_USER_MSG.render(
+            plot_descr=plot_descr, data=data.to_csv(index=False)
+        )
+    return user_msg
 
 
 def get_representative_sample(df, max_tokens):
     # FIXME: Add take top n reviews sorted by similarity distance if similarity_query is not None
-    avg_tokens_pr_review = (
-        df["content"]
-        .sample(300 if len(df) > 300 else len(df))
-        .apply(lambda x: num_tokens_from_string(x, model="gpt-4"))
-        .mean()
-    )
-    n_reviews = int(max_tokens / avg_tokens_pr_review)
-    if n_reviews > len(df):
+    df = df.reset_index(drop=True)
+    n_tokens = tokens.count_tokens(df["content"], model="gpt-4")
+    if n_tokens.sum() + REVIEW_TOKEN_OVERHEAD * len(df) <= max_tokens:
         return df
     else:
         df["combined"] = list(
@@ -92,7 +122,10 @@ def get_representative_sample(df, max_tokens):
         )
         weight = df["combined"].value_counts(normalize=True)
         df["combined_weight"] = df["combined"].apply(lambda x: weight[x])
-        df_sample = df.sample(n_reviews, weights=df["combined_weight"])
+        # Draw reviews in weighted random order until the token budget is full
+        order = df.sample(frac=1, weights=df["combined_weight"]).index
+        keep = tokens.pack(n_tokens[order], max_tokens, overhead=REVIEW_TOKEN_OVERHEAD)
+        df_sample = df.loc[keep]
         return df_sample
 
 
@@ -103,7 +136,14 @@ Queries:
 [
     {
         SQLQuery: "SQL query string",
-        SQLResult: "SQL query result"
+        SQLResult: "SQL query result",
+        Truncated: "true if the SQL result holds only the first rows of the result",
+        ElapsedSeconds: "Seconds the SQL query took"
+    },
+    /* or, if the SQL query could not be created or run */
+    {
+        SQLQuery: "SQL query string or null",
+        SQLError: "The error message"
     },
     /* more queries */
 ]
@@ -0,0 +1,230 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Optional
+
+# SQLite limits the number of host parameters in a single statement
+MAX_SQLITE_VARS = 500
+
+
+class DiskCache:
+    def __init__(self, path: str, table: str, max_entries: int = 100_000):
+        """
+        Persistent key/value cache stored in a local SQLite file. Once the cache
+        holds more than `max_entries` entries the least recently used are evicted.
+        Safe to share between threads and processes.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.table = table
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} "
+                "(key TEXT PRIMARY KEY, value BLOB, last_used REAL)"
+            )
+            self.conn.execute(
+                f"CREATE INDEX IF NOT EXISTS {table}_last_used ON {table} (last_used)"
+            )
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        found = {}
+        with self.lock, self.conn:
+            for i in range(0, len(keys), MAX_SQLITE_VARS):
+                chunk = keys[i : i + MAX_SQLITE_VARS]
+                params = ",".join("?" * len(chunk))
+                rows = self.conn.execute(
+                    f"SELECT key, value FROM {self.table} WHERE key IN ({params})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+                if rows:
+                    hit_params = ",".join("?" * len(rows))
+                    self.conn.execute(
+                        f"UPDATE {self.table} SET last_used = ? "
+                        f"WHERE key IN ({hit_params})",
+                        [time.time()] + [key for key, _ in rows],
+                    )
+            self.hits += len(found)
+            self.misses += len(set(keys)) - len(found)
+        return found
+
+    def set_many(self, items: dict[str, bytes]) -> None:
+        now = time.time()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, last_used) "
+                "VALUES (?, ?, ?)",
+                [(key, value, now) for key, value in items.items()],
+            )
+            self.conn.execute(
+                f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+                "ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else 0.0,
+        )
+
+
+class EmbeddingCache:
+    def __init__(self, path: str, max_entries: int = 100_000):
+        """
+        Cache of embeddings keyed by (model, hash of whitespace normalized text).
+        Embeddings are stored as float32, the precision pgvector stores them in.
+        """
+        self.cache = DiskCache(path, table="embedding", max_entries=max_entries)
+
+    def get_many(self, model: str, texts: list[str]) -> list[Optional[list[float]]]:
+        keys = [self.key(model, text) for text in texts]
+        found = self.cache.get_many(keys)
+        return [
+            array("f", found[key]).tolist() if key in found else None for key in keys
+        ]
+
+    def set_many(self, model: str, texts: list[str], embeddings: list[list[float]]):
+        self.cache.set_many(
+            {
+                self.key(model, text): array("f", embedding).tobytes()
+                for text, embedding in zip(texts, embeddings)
+            }
+        )
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        text = " ".join(text.split())
+        return f"{model}:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+class CompletionCache:
+    def __init__(self, path: str, max_entries: int = 10_000, ttl: float = 86_400):
+        """
+        Cache of deterministic (temperature 0) LLM completions keyed by a hash of
+        (model, messages, temperature, stop). Entries older than `ttl` seconds are
+        ignored and refreshed. Counts the seconds saved by hits.
+        """
+        self.cache = DiskCache(path, table="completion", max_entries=max_entries)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, model: str, messages: list[dict], temperature, stop):
+        key = self.key(model, messages, temperature, stop)
+        value = self.cache.get_many([key]).get(key)
+        entry = json.loads(value) if value is not None else None
+        with self.lock:
+            if entry is None or time.time() - entry["created_at"] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_seconds += entry["seconds"]
+        return entry["completion"]
+
+    def set(
+        self, model: str, messages: list[dict], temperature, stop, completion, seconds
+    ) -> None:
+        """`seconds` is the latency of the completion, saved by each later hit."""
+        entry = dict(completion=completion, seconds=seconds, created_at=time.time())
+        key = self.key(model, messages, temperature, stop)
+        self.cache.set_many({key: json.dumps(entry).encode()})
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else 0.0,
+            saved_seconds=self.saved_seconds,
+        )
+
+    @staticmethod
+    def key(model: str, messages: list[dict], temperature, stop) -> str:
+        request = json.dumps(
+            [model, messages, temperature, stop], sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(request.encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, max_entries: int = 256, max_bytes: int = 256 * 2**20):
+        """
+        In-memory LRU cache of query results. Once it holds more than `max_entries`
+        results or `max_bytes` bytes the least recently used are evicted.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return self.entries[key][0]
+
+    def set(self, key, value) -> None:
+        size = nbytes(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.n_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.n_bytes += size
+            while len(self.entries) > self.max_entries or self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.n_bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_rate=self.hits / requests if requests else 0.0,
+            entries=len(self.entries),
+            bytes=self.n_bytes,
+            evictions=self.evictions,
+        )
+
+
+def nbytes(value) -> int:
+    """Approximate memory used by a result: DataFrames, tuples of them or other."""
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return sys.getsizeof(value)
@@ -6,45 +6,38 @@ from assistant.llm import GPT
 from jinja2 import Template
 from assistant.config import config
 from assistant.db import crud
-from assistant import query, plot, analyse
+from assistant import query, plot, analyse, resolve
 import os
 import pandas as pd
 from datetime import datetime
 import streamlit
 from copy import copy
+from assistant.concurrency import run_concurrently, containers
 
 
 def chat(messages: list[dict], st: streamlit = None):
     gpt = GPT(log=True, question=messages[-1]["content"], st=st)
 
-    with gpt.st.status("Working"):
-        metadata = extract_metadata(messages, gpt)
-        plan = create_plan(messages, gpt)
-
-    analysis_msgs = []
-    for step in plan:
-        action, action_array = step.split(":")
-        action = action.strip()
-        action_array = ast.literal_eval(action_array.strip())
-
-        if action == "SQL":
-            queries_result = query.sql(queries=action_array, metadata=metadata, gpt=gpt)
-            analysis = analyse.sql_query(queries=queries_result, gpt=gpt)
-        elif action == "PLOT":
-            plots = plot.create(metadata=metadata, plots=action_array)
-            analysis = analyse.plots(
-                plots=plots, companies=metadata["companies"], gpt=gpt
-            )
-        elif action == "ANALYSE REVIEWS":
-            df_reviews = query.data(queries=action_array, metadata=metadata)
-            analysis = analyse.review_text(df_reviews=df_reviews, gpt=gpt)
-        else:
-            raise ValueError(f"Unexpected action: {action}")
-
-        if type(analysis) == str:
-            analysis_msgs.append(dict(role="assistant", content=analysis))
-        else:
-            analysis_msgs.extend(analysis)
+    # Metadata extraction and planning don't depend on each other, so they run
+    # concurrently, each writing into its own container to keep the UI order.
+    with gpt.st.status("Working") as status:
+        metadata_container, plan_container = containers(status, 2)
+        metadata, plan = run_concurrently(
+            [
+                (extract_metadata, messages, gpt.with_st(metadata_container)),
+                (create_plan, messages, gpt.with_st(plan_container)),
+            ]
+        )
+
+    # Plan steps run concurrently too. Their containers are created in plan order
+    # up front, so results show up in plan order whichever step finishes first.
+    steps_analysis = run_concurrently(
+        [
+            (run_step, step, copy(metadata), gpt.with_st(container))
+            for step, container in zip(plan, containers(gpt.st, len(plan)))
+        ]
+    )
+    analysis_msgs = [msg for step_msgs in steps_analysis for msg in step_msgs]
 
     output = [dict(role="assistant", content=m) for m in [metadata, plan]] + [
         m for m in analysis_msgs if m["role"] != "plot"
@@ -54,6 +47,29 @@ def chat(messages: list[dict], st: streamlit = None):
     return analysis_msgs
 
 
+def run_step(step: str, metadata: dict, gpt) -> list[dict]:
+    action, action_array = step.split(":")
+    action = action.strip()
+    action_array = ast.literal_eval(action_array.strip())
+
+    if action == "SQL":
+        queries_result = query.sql(queries=action_array, metadata=metadata, gpt=gpt)
+        analysis = analyse.sql_query(queries=queries_result, gpt=gpt)
+    elif action == "PLOT":
+        plots = plot.create(metadata=metadata, plots=action_array)
+        analysis = analyse.plots(plots=plots, companies=metadata["companies"], gpt=gpt)
+    elif action == "ANALYSE REVIEWS":
+        df_reviews = query.data(queries=action_array, metadata=metadata)
+        analysis = analyse.review_text(df_reviews=df_reviews, gpt=gpt)
+    else:
+        raise ValueError(f"Unexpected action: {action}")
+
+    if type(analysis) == str:
+        return [dict(role="assistant", content=analysis)]
+    else:
+        return analysis
+
+
 def extract_metadata(messages: list[dict], gpt):
     response_txt = gpt.completion(
         messages=[
@@ -69,9 +85,7 @@ def extract_metadata(messages: list[dict], gpt):
         kind="chain",
     )
     metadata = json.loads(response_txt)
-    metadata["companies"] = [
-        crud.company.most_similar_name(company) for company in metadata["companies"]
-    ]
+    metadata["companies"] = resolve.company_names.resolve(metadata["companies"])
     metadata["start_date"] = str2date(metadata["start_date"])
     metadata["end_date"] = str2date(metadata["end_date"])
     return metadata
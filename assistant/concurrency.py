@@ -0,0 +1,26 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+
+def run_concurrently(tasks: list[tuple]) -> list:
+    """
+    Run (func, *args) tasks in a thread pool and return their results in task
+    order. The threads get the streamlit script context, so they can write to
+    the page. The first exception in task order is raised.
+    """
+    if not tasks:
+        return []
+    ctx = get_script_run_ctx()
+
+    def run(func, *args):
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return func(*args)
+
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        futures = [pool.submit(run, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def containers(st, n: int) -> list:
+    return [st.container() if st is not None else None for _ in range(n)]
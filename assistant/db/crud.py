@@ -1,18 +1,116 @@
-from typing import Generic, Type, TypeVar, List, Tuple
-from sqlmodel import SQLModel, Session, select, delete, update, and_, or_
+import re
+import json
+import time
+import asyncio
+import inspect
+import tempfile
+import functools
+from copy import deepcopy
+from datetime import date, datetime
+from typing import Generic, Type, TypeVar, List, Tuple, Union, Iterator
+from sqlmodel import SQLModel, Session, select, delete, update, and_
+from sqlalchemy import DateTime, Float, func, literal, literal_column, text, tuple_
+from sqlalchemy import union_all
 from sqlalchemy.future import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.dialects.postgresql import insert
+from sqlmodel.sql.sqltypes import AutoString
+from pgvector.sqlalchemy import Vector
 from assistant.db import models
-from assistant.db.db import engine
+from assistant.db.db import engine, get_async_engine, REVIEW_PARTITIONED
 import pandas as pd
 from assistant.llm import embed
+from assistant.cache import ResultCache
+from assistant.config import config
 
 ModelType = TypeVar("ModelType", bound=SQLModel)
 EngineType = TypeVar("EngineType", bound=Engine)
 
 
+class DataVersionTracker:
+    def __init__(self, engine, ttl: float = 5):
+        """
+        Version of the data in the db: the sum of the write counters in the
+        dataversion table. Re-read at most every `ttl` seconds, or on the next
+        read after a write by this process, so writes by other processes (e.g.
+        the scrapers) are picked up within `ttl` seconds.
+        """
+        self.engine = engine
+        self.ttl = ttl
+        self.version = None
+        self.checked_at = 0.0
+
+    def get(self) -> int:
+        if self.version is None or time.monotonic() - self.checked_at > self.ttl:
+            stmt = select(func.coalesce(func.sum(models.DataVersion.version), 0))
+            with Session(self.engine) as session:
+                self.version = session.execute(stmt).scalar()
+            self.checked_at = time.monotonic()
+        return self.version
+
+    def invalidate(self) -> None:
+        self.version = None
+
+
+data_version = DataVersionTracker(engine, ttl=float(config.get("DATA_VERSION_TTL", 5)))
+result_cache = ResultCache(
+    max_entries=int(config.get("RESULT_CACHE_MAX_ENTRIES", 256)),
+    max_bytes=int(config.get("RESULT_CACHE_MAX_MB", 256)) * 2**20,
+)
+
+
+def cached_result(method):
+    """
+    Serve the results of a read from `result_cache` while the data version is
+    unchanged. The key holds the table, the arguments and the normalized SQL.
+    Pass `use_cache=False` to always query the db.
+    """
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def wrapper(*args, use_cache: bool = True, **kwargs):
+        if not use_cache:
+            return method(*args, **kwargs)
+
+        arguments = signature.bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = dict(arguments.arguments)
+        owner = arguments.pop("self", None)
+        if "sql" in arguments:
+            arguments["sql"] = normalize_sql(arguments["sql"])
+        table = owner.model.__tablename__ if owner is not None else None
+        key = json.dumps(
+            [method.__qualname__, table, arguments, data_version.get()],
+            sort_keys=True,
+            default=str,
+        )
+
+        result = result_cache.get(key)
+        if result is None:
+            result = method(*args, **kwargs)
+            result_cache.set(key, result)
+        # Callers modify the returned DataFrames, so never hand out the cached one
+        return deepcopy(result)
+
+    return wrapper
+
+
+def normalize_sql(sql: str) -> str:
+    """Collapse whitespace and drop trailing semicolons outside string literals."""
+    parts = re.split(r"('(?:[^']|'')*')", sql.strip().rstrip(";"))
+    return "".join(
+        part if i % 2 else re.sub(r"\s+", " ", part) for i, part in enumerate(parts)
+    )
+
+
 class CRUDBase(Generic[ModelType, EngineType]):
-    def __init__(self, model: Type[ModelType], engine: Type[EngineType]):
+    def __init__(
+        self,
+        model: Type[ModelType],
+        engine: Type[EngineType],
+        conflict_cols: list[str] = ["id"],
+    ):
         """
         CRUD object with default methods to Create, Read, Update, Delete (CRUD).
 
@@ -20,19 +118,120 @@ class CRUDBase(Generic[ModelType, EngineType]):
 
         * `model`: A SQLModel class
         * `engine`: A sqlalchemy engine
+        * `conflict_cols`: Unique columns identifying a row in upserts
         """
         self.model = model
         self.engine = engine
+        self.conflict_cols = conflict_cols
+        # Bumped on every write, so in-process caches of the table can refresh
+        self.version = 0
 
     def get(self, id) -> ModelType:
         with Session(self.engine) as session:
             return session.get(self.model, id)
 
-    def get_table(self):
-        with Session(self.engine) as session:
-            stmt = select(self.model)
-            result = session.exec(stmt).all()
-        return pd.DataFrame([r.dict() for r in result])
+    def get_table(self, cols: list[str] = None, include_vectors: bool = False):
+        return self.export(cols=cols, include_vectors=include_vectors)
+
+    def _table_cols(self, include_vectors: bool = False) -> list[str]:
+        """All columns in field order, leaving out vector columns by default."""
+        columns = self.model.__table__.columns
+        return [
+            c
+            for c in self.model.__fields__
+            if include_vectors or not isinstance(columns[c].type, Vector)
+        ]
+
+    def export(
+        self,
+        cols: list[str] = None,
+        include_vectors: bool = False,
+        format: str = "pandas",
+        path: str = None,
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+        chunk_size: int = 1 << 26,
+        verbose: bool = False,
+    ):
+        """
+        Columnar export of the table. The rows are streamed by COPY as CSV and parsed
+        column-wise by Arrow, so no ORM objects or per row Python values are created.
+
+        **Parameters**
+
+        * `cols`: Columns to export. Defaults to all columns except vector columns
+        * `include_vectors`: Also export the vector columns when `cols` isn't given
+        * `format`: "pandas", "arrow" or "parquet". For "parquet" the rows are
+          written to `path` in batches of about `chunk_size` bytes of CSV
+        * `equals`, `_in`, `start_date`, `end_date`: Filters, same as in `where`
+        * `verbose`: Print the number of rows exported and rows per second
+        """
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+
+        columns = self.model.__table__.columns
+        cols = cols if cols else self._table_cols(include_vectors)
+        column_types = {c: arrow_type(columns[c].type) for c in cols}
+        vector_cols = [c for c in cols if isinstance(columns[c].type, Vector)]
+
+        stmt = select(*[getattr(self.model, c) for c in cols])
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
+        compiled = stmt.compile(
+            dialect=self.engine.dialect, compile_kwargs={"render_postcompile": True}
+        )
+
+        start = time.perf_counter()
+        conn = self.engine.raw_connection()
+        try:
+            with conn.cursor() as cursor, tempfile.TemporaryFile() as f:
+                query = cursor.mogrify(compiled.string, compiled.params).decode()
+                cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", f)
+                f.seek(0)
+                convert_options = pa_csv.ConvertOptions(
+                    column_types=column_types,
+                    strings_can_be_null=True,
+                    quoted_strings_can_be_null=False,
+                    true_values=["t"],
+                    false_values=["f"],
+                )
+                if format == "parquet":
+                    import pyarrow.parquet as pq
+
+                    read_options = pa_csv.ReadOptions(block_size=chunk_size)
+                    reader = pa_csv.open_csv(
+                        f, read_options=read_options, convert_options=convert_options
+                    )
+                    n_rows, writer = 0, None
+                    for batch in reader:
+                        table = pa.Table.from_batches([batch])
+                        table = parse_vectors(table, vector_cols)
+                        if writer is None:
+                            writer = pq.ParquetWriter(path, table.schema)
+                        writer.write_table(table)
+                        n_rows += table.num_rows
+                    if writer is not None:
+                        writer.close()
+                    result = path
+                else:
+                    table = pa_csv.read_csv(f, convert_options=convert_options)
+                    table = parse_vectors(table, vector_cols)
+                    n_rows = table.num_rows
+                    result = table.to_pandas() if format == "pandas" else table
+        finally:
+            conn.close()
+
+        elapsed = time.perf_counter() - start
+        self.export_stats = dict(
+            rows=n_rows, seconds=elapsed, rows_per_sec=n_rows / max(elapsed, 1e-9)
+        )
+        if verbose:
+            print(
+                f"Exported {n_rows} rows from {self.model.__tablename__} in "
+                f"{elapsed:.2f}s ({self.export_stats['rows_per_sec']:.0f} rows/s)"
+            )
+        return result
 
     def get_multi(self, offset: int = 0, limit: int = 100) -> List[ModelType]:
         with Session(self.engine) as session:
@@ -42,6 +241,8 @@ class CRUDBase(Generic[ModelType, EngineType]):
         with Session(self.engine) as session, session.begin():
             stmt = insert(self.model).values(**model_obj.dict(exclude_unset=True))
             session.exec(stmt)
+            self._bump_data_version(session)
+        self._written()
 
     def upsert(self, model_obj: ModelType) -> ModelType:
         with Session(self.engine) as session, session.begin():
@@ -49,23 +250,129 @@ class CRUDBase(Generic[ModelType, EngineType]):
                 insert(self.model)
                 .values(**model_obj.dict(exclude_unset=True))
                 .on_conflict_do_update(
-                    index_elements=["id"],
+                    index_elements=self.conflict_cols,
                     set_=model_obj.dict(exclude_unset=True),
                 )
             )
             session.exec(stmt)
+            self._bump_data_version(session)
+        self._written()
+
+    def create_many(
+        self, model_objs: List[Union[ModelType, dict]], chunk_size: int = 1000
+    ) -> int:
+        """
+        Insert rows in multi-row INSERT statements of up to `chunk_size` rows, all
+        within a single transaction. Returns the number of inserted rows.
+        """
+        n_rows = 0
+        with Session(self.engine) as session, session.begin():
+            for rows in self._row_chunks(model_objs, chunk_size):
+                session.exec(insert(self.model).values(rows))
+                n_rows += len(rows)
+            self._bump_data_version(session)
+        self._written()
+        return n_rows
+
+    def upsert_many(
+        self, model_objs: List[Union[ModelType, dict]], chunk_size: int = 1000
+    ) -> dict:
+        """
+        Upsert rows in multi-row INSERT ... ON CONFLICT statements of up to
+        `chunk_size` rows, all within a single transaction. Existing rows are only
+        written if a value differs.
+
+        Returns the number of inserted, updated and unchanged rows.
+        """
+        # A statement can't update the same row twice, so keep the last row per key
+        rows_by_id = {}
+        for model_obj in model_objs:
+            row = (
+                model_obj
+                if isinstance(model_obj, dict)
+                else model_obj.dict(exclude_unset=True)
+            )
+            rows_by_id[tuple(row[c] for c in self.conflict_cols)] = row
+
+        counts = dict(inserted=0, updated=0, unchanged=0)
+        with Session(self.engine) as session, session.begin():
+            for rows in self._row_chunks(rows_by_id.values(), chunk_size):
+                stmt = insert(self.model).values(rows)
+                update_cols = [c for c in rows[0] if c not in self.conflict_cols]
+                if update_cols:
+                    table_cols = tuple_(
+                        *[self.model.__table__.c[c] for c in update_cols]
+                    )
+                    excluded_cols = tuple_(*[stmt.excluded[c] for c in update_cols])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=self.conflict_cols,
+                        set_={c: stmt.excluded[c] for c in update_cols},
+                        where=table_cols.is_distinct_from(excluded_cols),
+                    )
+                else:
+                    stmt = stmt.on_conflict_do_nothing(
+                        index_elements=self.conflict_cols
+                    )
+
+                # xmax is 0 for freshly inserted rows. Skipped rows aren't returned.
+                stmt = stmt.returning(literal_column("xmax = 0").label("inserted"))
+                written = session.execute(stmt).scalars().all()
+                n_inserted = sum(written)
+                counts["inserted"] += n_inserted
+                counts["updated"] += len(written) - n_inserted
+                counts["unchanged"] += len(rows) - len(written)
+            # Unchanged rows don't make cached results stale
+            if counts["inserted"] or counts["updated"]:
+                self._bump_data_version(session)
+        self._written()
+        return counts
+
+    @staticmethod
+    def _row_chunks(model_objs, chunk_size):
+        # Rows in a multi-row INSERT must share columns, so group them by column set
+        groups = {}
+        for model_obj in model_objs:
+            row = (
+                model_obj
+                if isinstance(model_obj, dict)
+                else model_obj.dict(exclude_unset=True)
+            )
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+        for rows in groups.values():
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i : i + chunk_size]
 
     def update(self, model_obj: ModelType) -> ModelType:
         model_update = model_obj.dict(exclude_unset=True)
         with Session(self.engine) as session, session.begin():
             stmt = update(self.model).where(self.model.id == model_obj.id)
             session.exec(stmt.values(**model_update))
+            self._bump_data_version(session)
+        self._written()
 
     def delete(self, id) -> None:
         with Session(self.engine) as session, session.begin():
             stmt = delete(self.model).where(self.model.id == id)
             session.exec(stmt)
+            self._bump_data_version(session)
+        self._written()
+
+    def _bump_data_version(self, session) -> None:
+        # Runs in the write's transaction, so the new version and rows commit together
+        stmt = insert(models.DataVersion).values(
+            table_name=self.model.__tablename__, version=1
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["table_name"],
+            set_=dict(version=models.DataVersion.version + 1),
+        )
+        session.execute(stmt)
+
+    def _written(self) -> None:
+        self.version += 1
+        data_version.invalidate()
 
+    @cached_result
     def where(
         self,
         equals: dict = {},
@@ -75,50 +382,339 @@ class CRUDBase(Generic[ModelType, EngineType]):
         cols=[],
         limit=False,
         similarity_query=False,
-    ) -> List[ModelType]:
+        ef_search: int = None,
+        probes: int = None,
+        quantization: str = None,
+        rerank: int = 4,
+    ) -> pd.DataFrame:
+        """
+        Filtered read, optionally ordered by similarity to `similarity_query`.
+        Unfiltered similarity search with a `limit` uses the ANN index on embedding,
+        while filtered searches scan the matching rows exactly. Passing
+        `ef_search` (HNSW) or `probes` (IVFFlat) always uses the index and trades
+        speed for recall for this query only.
+
+        With `quantization` ("half" or "binary") and a `limit`, `rerank` * `limit`
+        candidates are searched on the quantized index (see
+        db.create_vector_indexes) and re-ranked by their full embedding distance.
+        """
+        cols = cols if cols else list(self.model.__fields__.keys())
+        stmt = self._where_stmt(
+            equals,
+            _in,
+            start_date,
+            end_date,
+            cols,
+            limit,
+            similarity_query,
+            quantization,
+            rerank,
+        )
+        search_params = self._search_params(
+            similarity_query,
+            limit,
+            quantization,
+            rerank,
+            self._is_filtered(equals, _in, start_date, end_date),
+            ef_search,
+            probes,
+        )
         with Session(self.engine) as session:
-            stmt = (
-                select(*[getattr(self.model, s) for s in cols])
-                if cols
-                else select(self.model)
-            )
-            if equals:
-                stmt = stmt.where(
-                    and_(*[getattr(self.model, k) == v for k, v in equals.items() if v])
-                )
-            if _in:
-                stmt = stmt.where(
-                    or_(*[getattr(self.model, k).in_(v) for k, v in _in.items() if v])
-                )
+            self._set_search_params(session, **search_params)
+            result = session.execute(stmt).all()
+        return pd.DataFrame.from_records(
+            result,
+            columns=cols,
+        )
 
-            if start_date and end_date:
-                stmt = stmt.where(self.model.timestamp.between(start_date, end_date))
-            elif start_date:
-                stmt = stmt.where(self.model.timestamp >= start_date)
-            elif end_date:
-                stmt = stmt.where(self.model.timestamp <= end_date)
-            else:
-                pass
+    @cached_result
+    def where_many(
+        self,
+        similarity_queries: list[str],
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+        cols=[],
+        limit=False,
+        ef_search: int = None,
+        probes: int = None,
+        quantization: str = None,
+        rerank: int = 4,
+    ) -> pd.DataFrame:
+        """
+        Same as `where` for each of `similarity_queries`, with `limit` rows per
+        query. The queries are embedded in one call and read in a single UNION ALL
+        query, and each row gets the `similarity_query` it was retrieved for.
+        """
+        cols = cols if cols else list(self.model.__fields__.keys())
+        if not similarity_queries:
+            return pd.DataFrame(columns=cols + ["similarity_query"])
 
-            if similarity_query:
-                query_emb = embed(similarity_query)[0]
-                stmt = stmt.order_by(self.model.embedding.l2_distance(query_emb))
-            else:
-                if "timestamp" in cols:
-                    stmt.order_by(self.model.timestamp.desc())
+        query_embs = embed(similarity_queries)
+        stmts = [
+            self._where_stmt(
+                equals,
+                _in,
+                start_date,
+                end_date,
+                cols,
+                limit,
+                query,
+                quantization,
+                rerank,
+                query_emb=query_emb,
+                with_distance=True,
+            ).add_columns(literal(i).label("query_idx"))
+            for i, (query, query_emb) in enumerate(zip(similarity_queries, query_embs))
+        ]
+        # UNION ALL doesn't guarantee the order of its rows, so sort them by query
+        # and distance after the union
+        rows = union_all(*stmts).subquery()
+        stmt = select(*[rows.c[c] for c in cols], rows.c.query_idx).order_by(
+            rows.c.query_idx, rows.c.distance
+        )
+        search_params = self._search_params(
+            True,
+            limit,
+            quantization,
+            rerank,
+            self._is_filtered(equals, _in, start_date, end_date),
+            ef_search,
+            probes,
+        )
+        with Session(self.engine) as session:
+            self._set_search_params(session, **search_params)
+            result = session.execute(stmt).all()
+
+        df = pd.DataFrame.from_records(result, columns=cols + ["query_idx"])
+        df["similarity_query"] = [similarity_queries[i] for i in df["query_idx"]]
+        return df.drop(columns="query_idx")
+
+    def where_iter(
+        self,
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+        cols=[],
+        limit=False,
+        similarity_query=False,
+        ef_search: int = None,
+        probes: int = None,
+        quantization: str = None,
+        rerank: int = 4,
+        chunk_size: int = 10_000,
+        arrow: bool = False,
+    ) -> Iterator[pd.DataFrame]:
+        """
+        Same as `where`, but streams the result from a server-side cursor and yields
+        DataFrames (or Arrow record batches if `arrow`) of up to `chunk_size` rows,
+        so large results can be processed in bounded memory.
+        """
+        cols = cols if cols else list(self.model.__fields__.keys())
+        stmt = self._where_stmt(
+            equals,
+            _in,
+            start_date,
+            end_date,
+            cols,
+            limit,
+            similarity_query,
+            quantization,
+            rerank,
+        )
+        search_params = self._search_params(
+            similarity_query,
+            limit,
+            quantization,
+            rerank,
+            self._is_filtered(equals, _in, start_date, end_date),
+            ef_search,
+            probes,
+        )
+        stmt = stmt.execution_options(stream_results=True, max_row_buffer=chunk_size)
+        with Session(self.engine) as session:
+            self._set_search_params(session, **search_params)
+            for rows in session.execute(stmt).partitions(chunk_size):
+                df = pd.DataFrame.from_records(rows, columns=cols)
+                if arrow:
+                    import pyarrow as pa
+
+                    yield pa.RecordBatch.from_pandas(df, preserve_index=False)
                 else:
-                    pass
+                    yield df
 
-            if limit:
-                stmt = stmt.limit(limit)
-            result = session.exec(stmt).all()
+    def _where_stmt(
+        self,
+        equals,
+        _in,
+        start_date,
+        end_date,
+        cols,
+        limit,
+        similarity_query,
+        quantization=None,
+        rerank=4,
+        query_emb=None,
+        with_distance=False,
+    ):
+        stmt = select(*[getattr(self.model, s) for s in cols])
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
 
-        result = session.exec(stmt).all()
-        cols = cols if cols else self.model.__fields__.keys()
-        return pd.DataFrame.from_records(
-            result,
-            columns=cols,
+        if similarity_query:
+            if query_emb is None:
+                query_emb = embed(similarity_query)[0]
+            distance = models.embedding_distance(self.model.embedding, query_emb)
+            if quantization and limit:
+                # Search candidates on the quantized index, then re-rank exactly
+                candidates = (
+                    stmt.add_columns(distance.label("distance"))
+                    .order_by(
+                        models.quantized_distance(
+                            self.model.embedding, query_emb, quantization
+                        )
+                    )
+                    .limit(int(limit * rerank))
+                    .subquery()
+                )
+                stmt = select(*[candidates.c[c] for c in cols])
+                if with_distance:
+                    stmt = stmt.add_columns(candidates.c.distance)
+                return stmt.order_by(candidates.c.distance).limit(limit)
+            if with_distance:
+                stmt = stmt.add_columns(distance.label("distance"))
+            stmt = stmt.order_by(distance)
+        elif "timestamp" in cols:
+            stmt = stmt.order_by(self.model.timestamp.desc())
+
+        if limit:
+            stmt = stmt.limit(limit)
+        return stmt
+
+    def _filter(self, stmt, equals=None, _in=None, start_date=None, end_date=None):
+        if equals:
+            stmt = stmt.where(
+                and_(*[getattr(self.model, k) == v for k, v in equals.items() if v])
+            )
+        if _in:
+            stmt = stmt.where(
+                and_(*[getattr(self.model, k).in_(v) for k, v in _in.items() if v])
+            )
+
+        if start_date and end_date:
+            stmt = stmt.where(self.model.timestamp.between(start_date, end_date))
+        elif start_date:
+            stmt = stmt.where(self.model.timestamp >= start_date)
+        elif end_date:
+            stmt = stmt.where(self.model.timestamp <= end_date)
+        else:
+            pass
+        return stmt
+
+    @staticmethod
+    def _search_params(
+        similarity_query, limit, quantization, rerank, filtered, ef_search, probes
+    ) -> dict:
+        """
+        Index settings for a similarity search, unless set by the caller. HNSW
+        returns at most ef_search rows (40 by default) and filters are applied to
+        those rows afterwards, so filtered searches and searches without a limit
+        scan the matching rows exactly, and other searches raise ef_search to the
+        number of rows or re-rank candidates wanted.
+        """
+        if not similarity_query or ef_search or probes:
+            return dict(ef_search=ef_search, probes=probes)
+        n_candidates = int(limit * rerank) if quantization and limit else limit
+        if filtered or not limit or n_candidates > MAX_EF_SEARCH:
+            return dict(exact=True)
+        return dict(ef_search=max(n_candidates, DEFAULT_EF_SEARCH))
+
+    @staticmethod
+    def _is_filtered(equals, _in, start_date, end_date) -> bool:
+        # Same conditions as _filter, which skips empty filter values
+        return bool(any(equals.values()) or any(_in.values()) or start_date or end_date)
+
+    @classmethod
+    def _set_search_params(cls, session, ef_search=None, probes=None, exact=False):
+        for stmt in cls._search_params_stmts(ef_search, probes, exact):
+            session.execute(stmt)
+
+    @staticmethod
+    def _search_params_stmts(ef_search=None, probes=None, exact=False):
+        # SET LOCAL only lasts for the transaction the query runs in
+        stmts = []
+        if ef_search:
+            stmts.append(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+        if probes:
+            stmts.append(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+        if exact:
+            # The vector indexes only support index scans, while the filters can
+            # still use bitmap scans on the btree indexes
+            stmts.append(text("SET LOCAL enable_indexscan = off"))
+        return stmts
+
+    ###   Async reads   ###
+    # Async variants of the read methods running on the asyncpg engine, so one
+    # server process can overlap the db calls of many concurrent chat sessions.
+    async def aget(self, id) -> ModelType:
+        async with AsyncSession(get_async_engine()) as session:
+            return await session.get(self.model, id)
+
+    async def aget_multi(self, offset: int = 0, limit: int = 100) -> List[ModelType]:
+        async with AsyncSession(get_async_engine()) as session:
+            stmt = select(self.model).offset(offset).limit(limit)
+            return (await session.execute(stmt)).scalars().all()
+
+    async def aget_table(self, cols: list[str] = None, include_vectors: bool = False):
+        cols = cols if cols else self._table_cols(include_vectors)
+        stmt = select(*[getattr(self.model, c) for c in cols])
+        async with AsyncSession(get_async_engine()) as session:
+            result = (await session.execute(stmt)).all()
+        return pd.DataFrame.from_records(result, columns=cols)
+
+    async def awhere(
+        self,
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+        cols=[],
+        limit=False,
+        similarity_query=False,
+        ef_search: int = None,
+        probes: int = None,
+        quantization: str = None,
+        rerank: int = 4,
+    ) -> pd.DataFrame:
+        cols = cols if cols else list(self.model.__fields__.keys())
+        # Building the statement may embed the similarity query, which blocks
+        stmt = await asyncio.to_thread(
+            self._where_stmt,
+            equals,
+            _in,
+            start_date,
+            end_date,
+            cols,
+            limit,
+            similarity_query,
+            quantization,
+            rerank,
         )
+        search_params = self._search_params(
+            similarity_query,
+            limit,
+            quantization,
+            rerank,
+            self._is_filtered(equals, _in, start_date, end_date),
+            ef_search,
+            probes,
+        )
+        async with AsyncSession(get_async_engine()) as session:
+            for params_stmt in self._search_params_stmts(**search_params):
+                await session.execute(params_stmt)
+            result = (await session.execute(stmt)).all()
+        return pd.DataFrame.from_records(result, columns=cols)
 
 
 class CRUDCompany(CRUDBase[models.Company, Engine]):
@@ -126,15 +722,178 @@ class CRUDCompany(CRUDBase[models.Company, Engine]):
         query_emb = embed(similarity_query)[0]
         with Session(self.engine) as session:
             stmt = select(self.model.name)
-            stmt = stmt.order_by(self.model.embedding.l2_distance(query_emb)).limit(1)
+            distance = models.embedding_distance(self.model.embedding, query_emb)
+            stmt = stmt.order_by(distance).limit(1)
             result = session.exec(stmt).first()
         return result
 
 
 class CRUDReview(CRUDBase[models.Review, EngineType]):
-    ...
+    def timestamps(self, ids: List[str]) -> dict:
+        """Timestamp of each review among `ids` that is already in the db."""
+        if not ids:
+            return {}
+        with Session(self.engine) as session:
+            stmt = select(self.model.id, self.model.timestamp).where(
+                self.model.id.in_(ids)
+            )
+            result = session.exec(stmt).all()
+        return dict(result)
+
+    def latest_timestamps(self) -> dict:
+        """Timestamp of the newest review of each company, keyed by company_id."""
+        with Session(self.engine) as session:
+            stmt = select(self.model.company_id, func.max(self.model.timestamp))
+            result = session.exec(stmt.group_by(self.model.company_id)).all()
+        return dict(result)
+
+    def time_range(
+        self, equals: dict = {}, _in: dict = {}, start_date=None, end_date=None
+    ) -> Tuple:
+        """Timestamps of the oldest and newest review matching the filters."""
+        stmt = select(func.min(self.model.timestamp), func.max(self.model.timestamp))
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
+        with Session(self.engine) as session:
+            return tuple(session.execute(stmt).one())
+
+    def aggregate(
+        self,
+        freq: str = None,
+        by: list[str] = [],
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+    ) -> pd.DataFrame:
+        """
+        Number of reviews, mean rating and number of reviews per star rating for
+        each `by` group and period, aggregated in the db. Takes the same filters
+        as `where`, so only the aggregated rows are transferred.
 
+        **Parameters**
+
+        * `freq`: Period of "D", "W" or "M". None for totals over the whole period
+        * `by`: Columns to group by, e.g. company and/or category
+        """
+        group_cols = [getattr(self.model, c) for c in by]
+        if freq:
+            trunc = literal_column(f"'{FREQ2DATE_TRUNC[freq]}'")
+            period = func.date_trunc(trunc, self.model.timestamp)
+            group_cols.append(period.label("period"))
+
+        rating = self.model.rating
+        stmt = select(
+            *group_cols,
+            func.count(rating).label("count"),
+            func.avg(rating).cast(Float).label("mean"),
+            *[func.count().filter(rating == i).label(str(i)) for i in range(1, 6)],
+        )
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
+        stmt = stmt.group_by(*group_cols).order_by(*group_cols)
+
+        with Session(self.engine) as session:
+            result = session.execute(stmt)
+            df = pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+        return df.rename(columns={str(i): i for i in range(1, 6)})
+
+
+class CRUDReviewRollup(CRUDBase[models.ReviewRollup, Engine]):
+    """
+    Reads of the daily rollup of the review table, answering the same aggregate
+    queries as `CRUDReview` from one row per company, category and day. Dates
+    filter whole days, so the rollup only answers queries with date filters.
+    """
+
+    def time_range(
+        self, equals: dict = {}, _in: dict = {}, start_date=None, end_date=None
+    ) -> Tuple:
+        """First and last day with reviews matching the filters."""
+        stmt = select(func.min(self.model.day), func.max(self.model.day))
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
+        with Session(self.engine) as session:
+            return tuple(session.execute(stmt).one())
+
+    def aggregate(
+        self,
+        freq: str = None,
+        by: list[str] = [],
+        equals: dict = {},
+        _in: dict = {},
+        start_date=None,
+        end_date=None,
+    ) -> pd.DataFrame:
+        """Same as `CRUDReview.aggregate`, summing the daily rollup rows."""
+        group_cols = [getattr(self.model, c) for c in by]
+        if freq:
+            trunc = literal_column(f"'{FREQ2DATE_TRUNC[freq]}'")
+            # Truncate a timestamp, not a timestamptz, like CRUDReview.aggregate
+            period = func.date_trunc(trunc, self.model.day.cast(DateTime))
+            group_cols.append(period.label("period"))
+
+        n_reviews = func.sum(self.model.n_reviews)
+        stmt = select(
+            *group_cols,
+            n_reviews.label("count"),
+            (func.sum(self.model.rating_sum) / func.cast(n_reviews, Float)).label(
+                "mean"
+            ),
+            *[
+                func.sum(getattr(self.model, f"n_{i}")).label(str(i))
+                for i in range(1, 6)
+            ],
+        )
+        stmt = self._filter(stmt, equals, _in, start_date, end_date)
+        stmt = stmt.group_by(*group_cols).order_by(*group_cols)
+
+        with Session(self.engine) as session:
+            result = session.execute(stmt)
+            df = pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+        return df.rename(columns={str(i): i for i in range(1, 6)})
+
+    def _filter(self, stmt, equals=None, _in=None, start_date=None, end_date=None):
+        stmt = super()._filter(stmt, equals, _in)
+        if start_date:
+            stmt = stmt.where(self.model.day >= start_date)
+        if end_date:
+            stmt = stmt.where(self.model.day <= end_date)
+        return stmt
+
+
+def arrow_type(column_type):
+    import pyarrow as pa
+
+    # Vectors are exported as text and parsed by parse_vectors
+    if isinstance(column_type, (Vector, AutoString)):
+        return pa.string()
+    return {
+        int: pa.int64(),
+        float: pa.float64(),
+        str: pa.string(),
+        bool: pa.bool_(),
+        datetime: pa.timestamp("us"),
+        date: pa.date32(),
+    }[column_type.python_type]
 
+
+def parse_vectors(table, vector_cols: list[str]):
+    """Parse vector columns exported as text like "[1,2,3]" to float32 lists."""
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    for col in vector_cols:
+        values = pc.split_pattern(pc.utf8_trim(table[col], "[]"), ",")
+        values = values.cast(pa.list_(pa.float32()))
+        table = table.set_column(table.schema.get_field_index(col), col, values)
+    return table
+
+
+FREQ2DATE_TRUNC = {"D": "day", "W": "week", "M": "month"}
+# Default and max hnsw.ef_search of pgvector
+DEFAULT_EF_SEARCH = 40
+MAX_EF_SEARCH = 1000
+
+
+@cached_result
 def exec_sql(sql):
     try:
         with Session(engine) as session:
@@ -147,5 +906,64 @@ def exec_sql(sql):
         raise ValueError("Invalid SQL query")
 
 
-review = CRUDReview(models.Review, engine)
+def exec_agent_sql(
+    sql: str, max_rows: int = 20, timeout: int = 10_000, use_cache: bool = True
+) -> Tuple[pd.DataFrame, dict]:
+    """
+    Run a SQL query written by the LLM in a read-only transaction, cancelled by
+    Postgres after `timeout` milliseconds. The query is wrapped in a LIMIT of
+    `max_rows` + 1, so Postgres stops after the rows needed to tell whether the
+    result was truncated, and at most `max_rows` rows are returned.
+
+    Returns the rows and dict(truncated=bool, elapsed=seconds). Only the rows and
+    the truncated flag are cached, so `elapsed` is the time of this call.
+    """
+    start = time.perf_counter()
+    df, truncated = _exec_agent_sql(sql, max_rows, timeout, use_cache=use_cache)
+    return df, dict(truncated=truncated, elapsed=time.perf_counter() - start)
+
+
+@cached_result
+def _exec_agent_sql(sql: str, max_rows: int, timeout: int) -> Tuple[pd.DataFrame, bool]:
+    # Wrapping in a subquery also rejects multiple statements, which could
+    # otherwise end the read-only transaction
+    sql = sql.strip().rstrip(";")
+    stmt = text(f"SELECT * FROM ({sql}) AS agent_query LIMIT {int(max_rows) + 1}")
+    try:
+        with engine.connect() as conn, conn.begin():
+            conn.execute(text("SET TRANSACTION READ ONLY"))
+            conn.execute(text(f"SET LOCAL statement_timeout = {int(timeout)}"))
+            result_proxy = conn.execute(stmt)
+            result = result_proxy.fetchmany(max_rows + 1)
+            column_names = list(result_proxy.keys())
+    except OperationalError as e:
+        if "statement timeout" in str(e):
+            raise ValueError(f"SQL query exceeded the {timeout} ms timeout")
+        raise ValueError("Invalid SQL query")
+    except Exception as e:
+        raise ValueError("Invalid SQL query")
+
+    df = pd.DataFrame.from_records(result[:max_rows], columns=column_names)
+    return df, len(result) > max_rows
+
+
+async def aexec_sql(sql):
+    try:
+        async with AsyncSession(get_async_engine()) as session:
+            result_proxy = await session.execute(text(sql))
+            result = result_proxy.all()
+            column_names = result_proxy.keys()
+        df = pd.DataFrame.from_records(result, columns=column_names)
+        return df
+    except Exception as e:
+        raise ValueError("Invalid SQL query")
+
+
+# The primary key of a partitioned review table includes the partition key
+review = CRUDReview(
+    models.Review,
+    engine,
+    conflict_cols=["id", "company"] if REVIEW_PARTITIONED else ["id"],
+)
 company = CRUDCompany(models.Company, engine)
+review_rollup = CRUDReviewRollup(models.ReviewRollup, engine)
@@ -1,11 +1,339 @@
+import asyncio
+import threading
+import weakref
 from assistant.db import models
 from sqlmodel import SQLModel, create_engine
+from sqlalchemy import text
 from assistant.config import config
 
 POSTGRES_SQLALCHEMY_URI = f'postgresql://{config["PGUSER"]}:{config["PGPASSWORD"]}@{config["PGHOST"]}:5432/{config["PGDATABASE"]}'
 
-engine = create_engine(POSTGRES_SQLALCHEMY_URI)
+# Connection pool and statement cache settings shared by the sync and async engine
+ENGINE_OPTIONS = dict(
+    pool_size=int(config.get("DB_POOL_SIZE", 5)),
+    max_overflow=int(config.get("DB_MAX_OVERFLOW", 10)),
+    pool_timeout=int(config.get("DB_POOL_TIMEOUT", 30)),
+    pool_recycle=int(config.get("DB_POOL_RECYCLE", 1800)),
+    pool_pre_ping=config.get("DB_POOL_PRE_PING", "true").lower() == "true",
+    query_cache_size=int(config.get("DB_QUERY_CACHE_SIZE", 500)),
+)
+
+engine = create_engine(POSTGRES_SQLALCHEMY_URI, **ENGINE_OPTIONS)
+
+# Partition the review table by company, see partition_review_table
+REVIEW_PARTITIONED = config.get("REVIEW_PARTITIONED", "false").lower() == "true"
+
+
+# One async engine per event loop, as asyncpg connections only work on the loop
+# that opened them
+_async_engines = weakref.WeakKeyDictionary()
+_async_engines_lock = threading.Lock()
+
+
+def get_async_engine():
+    """
+    asyncpg backed engine of the running event loop, created on first use so
+    asyncpg is only needed by callers of the async CRUD methods. Every loop, e.g.
+    the asyncio.run of each Streamlit session thread, gets its own engine and
+    connection pool. Await `dispose_async_engine` before a loop that is not
+    kept alive ends, to close its connections. asyncpg prepares statements
+    server side and caches up to DB_STATEMENT_CACHE_SIZE of them per connection.
+    """
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    loop = asyncio.get_running_loop()
+    with _async_engines_lock:
+        if loop not in _async_engines:
+            statement_cache_size = int(config.get("DB_STATEMENT_CACHE_SIZE", 100))
+            _async_engines[loop] = create_async_engine(
+                POSTGRES_SQLALCHEMY_URI.replace(
+                    "postgresql://", "postgresql+asyncpg://"
+                )
+                + f"?prepared_statement_cache_size={statement_cache_size}",
+                **ENGINE_OPTIONS,
+            )
+        return _async_engines[loop]
+
+
+async def dispose_async_engine():
+    """Close the pooled connections of the running event loop's engine."""
+    with _async_engines_lock:
+        async_engine = _async_engines.pop(asyncio.get_running_loop(), None)
+    if async_engine is not None:
+        await async_engine.dispose()
 
 
 def create_db_and_tables():
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
     SQLModel.metadata.create_all(engine)
+    if REVIEW_PARTITIONED:
+        partition_review_table()
+    create_review_rollup_triggers()
+
+
+def create_vector_indexes(method="hnsw", quantization: str = None, **params):
+    """
+    (Re)create the ANN indexes on the embedding columns with `method` ("hnsw" or
+    "ivfflat"). Params go in the index WITH clause, e.g. m and ef_construction for
+    HNSW. IVFFlat defaults to lists = rows / 1000 (sqrt(rows) above 1M rows), so
+    build it once the table holds data.
+
+    With `quantization` ("half" or "binary") the index is built on the half
+    precision or binary quantized embedding instead, for `where(quantization=...)`.
+    """
+    if quantization:
+        expression = models.QUANTIZED_EMBEDDING[quantization]
+        ops = models.QUANTIZED_OPS[quantization][models.EMBEDDING_DISTANCE]
+    else:
+        expression = "embedding"
+        ops = models.VECTOR_OPS[models.EMBEDDING_DISTANCE]
+    for model in [models.Company, models.Review]:
+        table_name = model.__tablename__
+        index_name = vector_index_name(table_name, quantization)
+        index_params = params
+        if method == "ivfflat" and "lists" not in params:
+            with engine.connect() as conn:
+                stmt = text(f"SELECT count(*) FROM {table_name}")
+                n_rows = conn.execute(stmt).scalar()
+            lists = n_rows // 1000 if n_rows <= 1_000_000 else int(n_rows**0.5)
+            index_params = dict(params, lists=max(lists, 1))
+
+        with_clause = ", ".join(f"{k} = {v}" for k, v in index_params.items())
+        with engine.begin() as conn:
+            conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+            conn.execute(
+                text(
+                    f"CREATE INDEX {index_name} ON {table_name} "
+                    f"USING {method} ({expression} {ops})"
+                    + (f" WITH ({with_clause})" if with_clause else "")
+                )
+            )
+
+
+def reindex_vector_indexes(quantization: str = None):
+    """Rebuild the vector indexes, e.g. after bulk loads skewed IVFFlat lists."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for model in [models.Company, models.Review]:
+            index_name = vector_index_name(model.__tablename__, quantization)
+            conn.execute(text(f"REINDEX INDEX CONCURRENTLY {index_name}"))
+
+
+def vector_index_name(table_name: str, quantization: str = None) -> str:
+    if quantization:
+        return f"{table_name}_embedding_{quantization}_idx"
+    return f"{table_name}_embedding_idx"
+
+
+def partition_review_table():
+    """
+    Convert review into a table partitioned by company, with a partition per
+    company and a default partition for companies added later. Indexes are
+    created on every partition, so a similarity search filtered on companies only
+    scans the vector indexes of their partitions. The primary key becomes
+    (id, company), so set REVIEW_PARTITIONED=true for upserts to match it.
+    """
+    with engine.begin() as conn:
+        stmt = text("SELECT relkind FROM pg_class WHERE relname = 'review'")
+        if conn.execute(stmt).scalar() == "p":
+            return
+
+        conn.execute(
+            text(
+                "CREATE TABLE review_partitioned (LIKE review INCLUDING DEFAULTS) "
+                "PARTITION BY LIST (company)"
+            )
+        )
+        conn.execute(
+            text("CREATE TABLE review_default PARTITION OF review_partitioned DEFAULT")
+        )
+        companies = conn.execute(text("SELECT id, name FROM company")).all()
+        for company_id, name in companies:
+            conn.execute(
+                text(
+                    f"CREATE TABLE review_p{company_id} PARTITION OF review_partitioned "
+                    "FOR VALUES IN (:name)"
+                ),
+                dict(name=name),
+            )
+        conn.execute(text("INSERT INTO review_partitioned SELECT * FROM review"))
+
+        # Swap the tables and recreate the keys and indexes under their usual names
+        conn.execute(text("DROP TABLE review"))
+        conn.execute(text("ALTER TABLE review_partitioned RENAME TO review"))
+        conn.execute(text("ALTER TABLE review ADD PRIMARY KEY (id, company)"))
+        conn.execute(
+            text(
+                "ALTER TABLE review ADD FOREIGN KEY (company_id) REFERENCES company (id)"
+            )
+        )
+        for index in models.Review.__table__.indexes:
+            index.create(conn)
+    create_review_rollup_triggers()
+
+
+def create_review_partitions():
+    """
+    Give companies added since partitioning their own partition, moving their
+    reviews out of the default partition.
+    """
+    with engine.begin() as conn:
+        stmt = text(
+            "SELECT id, name FROM company WHERE to_regclass('review_p' || id) IS NULL"
+        )
+        for company_id, name in conn.execute(stmt).all():
+            partition = f"review_p{company_id}"
+            conn.execute(
+                text(f"CREATE TABLE {partition} (LIKE review INCLUDING DEFAULTS)")
+            )
+            # Moving rows between partitions directly doesn't fire the rollup
+            # triggers on review, which is right as the reviews don't change
+            conn.execute(
+                text(
+                    f"INSERT INTO {partition} "
+                    "SELECT * FROM review_default WHERE company = :name"
+                ),
+                dict(name=name),
+            )
+            conn.execute(
+                text("DELETE FROM review_default WHERE company = :name"),
+                dict(name=name),
+            )
+            conn.execute(
+                text(
+                    f"ALTER TABLE review ATTACH PARTITION {partition} "
+                    "FOR VALUES IN (:name)"
+                ),
+                dict(name=name),
+            )
+
+
+# Rating counts of the review rows selected by {rows}, each counted with the weight
+# of its sign column, per (company_id, category, day)
+REVIEW_ROLLUP_SELECT = """
+SELECT
+    company_id,
+    coalesce(category, -1) AS category,
+    timestamp::date AS day,
+    max(company) AS company,
+    sum(sign) AS n_reviews,
+    sum(sign * rating) AS rating_sum,
+    sum(CASE WHEN rating = 1 THEN sign ELSE 0 END) AS n_1,
+    sum(CASE WHEN rating = 2 THEN sign ELSE 0 END) AS n_2,
+    sum(CASE WHEN rating = 3 THEN sign ELSE 0 END) AS n_3,
+    sum(CASE WHEN rating = 4 THEN sign ELSE 0 END) AS n_4,
+    sum(CASE WHEN rating = 5 THEN sign ELSE 0 END) AS n_5
+FROM ({rows}) changed
+GROUP BY company_id, coalesce(category, -1), timestamp::date
+"""
+
+REVIEW_ROLLUP_COLS = """
+    company_id, category, day, company, n_reviews, rating_sum,
+    n_1, n_2, n_3, n_4, n_5
+"""
+
+# Adds the counts of {rows} to the rollup, so a statement on review only touches
+# the rollup rows of the days it changed, whatever the size of the review table.
+# Days whose counts don't change, e.g. on updates of the review text, are skipped.
+REVIEW_ROLLUP_DELTA = """
+INSERT INTO reviewrollup AS r ({cols})
+SELECT * FROM ({select}) d
+WHERE (n_reviews, rating_sum, n_1, n_2, n_3, n_4, n_5) <> (0, 0, 0, 0, 0, 0, 0)
+ON CONFLICT (company_id, category, day) DO UPDATE SET
+    company = excluded.company,
+    n_reviews = r.n_reviews + excluded.n_reviews,
+    rating_sum = r.rating_sum + excluded.rating_sum,
+    n_1 = r.n_1 + excluded.n_1,
+    n_2 = r.n_2 + excluded.n_2,
+    n_3 = r.n_3 + excluded.n_3,
+    n_4 = r.n_4 + excluded.n_4,
+    n_5 = r.n_5 + excluded.n_5;
+"""
+
+REVIEW_ROLLUP_ROWS = (
+    "SELECT company_id, category, timestamp, company, rating, {sign} AS sign "
+    "FROM {table}"
+)
+
+# Removes the rollup rows of the days left without reviews
+REVIEW_ROLLUP_DELETE_EMPTY = """
+DELETE FROM reviewrollup r
+USING (
+    SELECT DISTINCT company_id, coalesce(category, -1) AS category,
+        timestamp::date AS day
+    FROM old_rows
+) k
+WHERE (r.company_id, r.category, r.day) = (k.company_id, k.category, k.day)
+    AND r.n_reviews = 0;
+"""
+
+# Applies the rows of a statement on review to the rollup, counting new rows with
+# sign 1 and old rows with sign -1. Transition tables only exist for the events
+# declaring them, so each event has its own branch.
+REVIEW_ROLLUP_FUNCTION = """
+CREATE OR REPLACE FUNCTION refresh_review_rollup() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+{insert}
+    ELSIF TG_OP = 'UPDATE' THEN
+{update}
+{delete_empty}
+    ELSE
+{delete}
+{delete_empty}
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def review_rollup_delta(*rows: str) -> str:
+    return REVIEW_ROLLUP_DELTA.format(
+        cols=REVIEW_ROLLUP_COLS,
+        select=REVIEW_ROLLUP_SELECT.format(rows=" UNION ALL ".join(rows)),
+    )
+
+
+# Statement level triggers with transition tables only take a single event each
+REVIEW_ROLLUP_TRIGGERS = {
+    "INSERT": "NEW TABLE AS new_rows",
+    "UPDATE": "NEW TABLE AS new_rows OLD TABLE AS old_rows",
+    "DELETE": "OLD TABLE AS old_rows",
+}
+
+
+def create_review_rollup_triggers():
+    new_rows = REVIEW_ROLLUP_ROWS.format(sign=1, table="new_rows")
+    old_rows = REVIEW_ROLLUP_ROWS.format(sign=-1, table="old_rows")
+    function = REVIEW_ROLLUP_FUNCTION.format(
+        insert=review_rollup_delta(new_rows),
+        update=review_rollup_delta(new_rows, old_rows),
+        delete=review_rollup_delta(old_rows),
+        delete_empty=REVIEW_ROLLUP_DELETE_EMPTY,
+    )
+    with engine.begin() as conn:
+        conn.execute(text(function))
+        for event, transition_tables in REVIEW_ROLLUP_TRIGGERS.items():
+            trigger = f"review_rollup_{event.lower()}"
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger} ON review"))
+            conn.execute(
+                text(
+                    f"CREATE TRIGGER {trigger} AFTER {event} ON review "
+                    f"REFERENCING {transition_tables} "
+                    "FOR EACH STATEMENT EXECUTE FUNCTION refresh_review_rollup()"
+                )
+            )
+
+
+def rebuild_review_rollup():
+    """Recompute the rollup table from scratch, e.g. to backfill existing reviews."""
+    with engine.begin() as conn:
+        conn.execute(text("TRUNCATE reviewrollup"))
+        rows = REVIEW_ROLLUP_ROWS.format(sign=1, table="review")
+        conn.execute(
+            text(
+                f"INSERT INTO reviewrollup ({REVIEW_ROLLUP_COLS}) "
+                + REVIEW_ROLLUP_SELECT.format(rows=rows)
+            )
+        )
@@ -1,7 +1,9 @@
 from sqlmodel import Field, SQLModel
 from typing import Optional
-from datetime import datetime
-from sqlalchemy import Column, DateTime, Boolean, Column, Integer, String
+from datetime import date, datetime
+from sqlalchemy import Column, DateTime, Boolean, Column, Integer, String, Index
+from sqlalchemy import Float, cast, func, literal
+from sqlalchemy.types import UserDefinedType
 from sqlalchemy import Column
 from sqlalchemy.ext.declarative import as_declarative, declared_attr
 from typing import Any
@@ -12,16 +14,109 @@ from pgvector.sqlalchemy import Vector
 from sqlalchemy import Column
 
 
+# Distance used to rank embeddings in similarity search. The vector indexes are
+# built with the matching operator class, otherwise Postgres can't use them.
+EMBEDDING_DISTANCE = "l2"
+VECTOR_OPS = {
+    "l2": "vector_l2_ops",
+    "cosine": "vector_cosine_ops",
+    "inner_product": "vector_ip_ops",
+}
+DISTANCE_FUNCS = {
+    "l2": "l2_distance",
+    "cosine": "cosine_distance",
+    "inner_product": "max_inner_product",
+}
+
+
+def vector_index(table_name: str, method="hnsw", **params) -> Index:
+    """ANN index on the embedding column. Params go in the index WITH clause."""
+    return Index(
+        f"{table_name}_embedding_idx",
+        "embedding",
+        postgresql_using=method,
+        postgresql_with=params,
+        postgresql_ops={"embedding": VECTOR_OPS[EMBEDDING_DISTANCE]},
+    )
+
+
+def embedding_distance(column, query_emb):
+    return getattr(column, DISTANCE_FUNCS[EMBEDDING_DISTANCE])(query_emb)
+
+
+# Compact embeddings for candidate search, which is then re-ranked with the full
+# float32 vectors. Only the indexes are built on the quantized expressions, the
+# tables keep the full vectors for the re-rank.
+EMBEDDING_DIM = 768
+QUANTIZED_EMBEDDING = {
+    "half": f"(embedding::halfvec({EMBEDDING_DIM}))",
+    "binary": f"(binary_quantize(embedding)::bit({EMBEDDING_DIM}))",
+}
+QUANTIZED_OPS = {
+    "half": {
+        "l2": "halfvec_l2_ops",
+        "cosine": "halfvec_cosine_ops",
+        "inner_product": "halfvec_ip_ops",
+    },
+    # Binary vectors are compared by hamming distance whatever the distance
+    "binary": dict.fromkeys(DISTANCE_FUNCS, "bit_hamming_ops"),
+}
+DISTANCE_OPERATORS = {"l2": "<->", "cosine": "<=>", "inner_product": "<#>"}
+
+
+class HalfVector(UserDefinedType):
+    cache_ok = True
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def get_col_spec(self, **kw):
+        return f"halfvec({self.dim})"
+
+
+class Bit(UserDefinedType):
+    cache_ok = True
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def get_col_spec(self, **kw):
+        return f"bit({self.dim})"
+
+
+def quantize(value, quantization: str):
+    """Same expressions as QUANTIZED_EMBEDDING, so Postgres can use the index."""
+    if quantization == "half":
+        return cast(value, HalfVector(EMBEDDING_DIM))
+    elif quantization == "binary":
+        return cast(func.binary_quantize(value), Bit(EMBEDDING_DIM))
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+
+def quantized_distance(column, query_emb, quantization: str):
+    # Cast the bound query explicitly, as binary_quantize also takes a halfvec
+    query = cast(literal(query_emb, Vector(EMBEDDING_DIM)), Vector(EMBEDDING_DIM))
+    query = quantize(query, quantization)
+    operator = (
+        "<~>" if quantization == "binary" else DISTANCE_OPERATORS[EMBEDDING_DISTANCE]
+    )
+    return quantize(column, quantization).op(operator, return_type=Float)(query)
+
+
 ###   Data tables   ###
 class Company(SQLModel, table=True):
+    __table_args__ = (vector_index("company", m=16, ef_construction=64),)
+
     id: Optional[int] = Field(primary_key=True, index=True)
     name: str
     homepage: str
     country: str
-    embedding: Optional[list[float]] = Field(sa_column=Column(Vector(768)))
+    embedding: Optional[list[float]] = Field(sa_column=Column(Vector(EMBEDDING_DIM)))
 
 
 class Review(SQLModel, table=True):
+    __table_args__ = (vector_index("review", m=16, ef_construction=64),)
+
     id: str = Field(primary_key=True, index=True)
     company_id: int = Field(foreign_key="company.id", index=True)
     company: str = Field(index=True)
@@ -33,4 +128,35 @@ class Review(SQLModel, table=True):
     rating: int
     likes: Optional[int] = None
     category: Optional[int] = Field(default=None, index=True)
-    embedding: Optional[list[float]] = Field(sa_column=Column(Vector(768)))
+    embedding: Optional[list[float]] = Field(sa_column=Column(Vector(EMBEDDING_DIM)))
+
+
+###   Bookkeeping tables   ###
+class DataVersion(SQLModel, table=True):
+    """
+    Write counter per table, bumped by every CRUD write so processes can tell
+    when their cached query results are stale.
+    """
+
+    table_name: str = Field(primary_key=True)
+    version: int = 0
+
+
+###   Rollup tables   ###
+class ReviewRollup(SQLModel, table=True):
+    """
+    Daily rating counts per company and category. Kept up to date by triggers on
+    the review table, see db.create_review_rollup_triggers.
+    """
+
+    company_id: int = Field(primary_key=True, foreign_key="company.id")
+    category: int = Field(primary_key=True)  # -1 for reviews without a category
+    day: date = Field(primary_key=True, index=True)
+    company: str = Field(index=True)
+    n_reviews: int
+    rating_sum: int
+    n_1: int
+    n_2: int
+    n_3: int
+    n_4: int
+    n_5: int
@@ -1,4 +1,4 @@
-import tiktoken
+import re
 import openai
 from typing import Union, Optional
 import wandb
@@ -6,8 +6,11 @@ from wandb.sdk.data_types.trace_tree import Trace
 from datetime import datetime
 import cohere
 from assistant.config import config
+from assistant.cache import EmbeddingCache, CompletionCache
+from assistant import tokens
 import streamlit
 import os
+from copy import copy
 
 os.environ[
     "WANDB_MODE"
@@ -23,21 +26,61 @@ run = wandb.init(
 LLM_cohere = cohere.Client(config["COHERE_API_KEY"])
 
 
-def embed(texts: Union[list[str], str], model="cohere"):
+EMBED_MODELS = {"cohere": "embed-multilingual-v2.0", "openai": "text-embedding-ada-002"}
+# Max number of texts per embedding request accepted by each provider
+EMBED_BATCH_SIZE = {"cohere": 96, "openai": 2048}
+
+embedding_cache = EmbeddingCache(
+    config.get("EMBEDDING_CACHE_PATH", ".cache/embeddings.sqlite"),
+    max_entries=int(config.get("EMBEDDING_CACHE_MAX_ENTRIES", 100_000)),
+)
+completion_cache = CompletionCache(
+    config.get("COMPLETION_CACHE_PATH", ".cache/completions.sqlite"),
+    max_entries=int(config.get("COMPLETION_CACHE_MAX_ENTRIES", 10_000)),
+    ttl=float(config.get("COMPLETION_CACHE_TTL", 86_400)),
+)
+
+
+def embed(texts: Union[list[str], str], model="cohere", use_cache=True):
     if isinstance(texts, str):
         texts = [texts]
     texts = [text.replace("\n", " ") for text in texts]
 
+    # Only texts missing from the cache are sent to the provider
+    model_name = f"{model}/{EMBED_MODELS.get(model, EMBED_MODELS['openai'])}"
+    if use_cache:
+        embeddings = embedding_cache.get_many(model_name, texts)
+    else:
+        embeddings = [None] * len(texts)
+    misses = list(dict.fromkeys(t for t, e in zip(texts, embeddings) if e is None))
+    if not misses:
+        return embeddings
+
+    batch_size = EMBED_BATCH_SIZE.get(model, EMBED_BATCH_SIZE["openai"])
+    miss_embeddings = []
+    for i in range(0, len(misses), batch_size):
+        miss_embeddings.extend(embed_batch(misses[i : i + batch_size], model=model))
+    if use_cache:
+        embedding_cache.set_many(model_name, misses, miss_embeddings)
+
+    miss_embeddings = dict(zip(misses, miss_embeddings))
+    return [
+        miss_embeddings[text] if embedding is None else embedding
+        for text, embedding in zip(texts, embeddings)
+    ]
+
+
+def embed_batch(texts: list[str], model="cohere"):
     if model == "cohere":
         response = LLM_cohere.embed(
             texts=texts,
-            model="embed-multilingual-v2.0",
+            model=EMBED_MODELS["cohere"],
         )
         embeddings = response.embeddings
     else:
         response = openai.Embedding.create(
             input=texts,
-            model="text-embedding-ada-002",
+            model=EMBED_MODELS["openai"],
         )
         embeddings = [data.get("embedding") for data in response.data]
 
@@ -60,6 +103,12 @@ class GPT:
                 inputs={"user": question},
             )
 
+    def with_st(self, st):
+        """Copy writing to another streamlit container, sharing the trace."""
+        gpt = copy(self)
+        gpt.st = st
+        return gpt
+
     def completion(
         self,
         messages,
@@ -70,29 +119,54 @@ class GPT:
         name="",
         kind="",
         write_to_streamlit=True,
+        use_cache=True,
     ) -> str:
         start = timestamp()
 
-        stream = True if self.st and write_to_streamlit else False
-        response = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            temperature=temperature,
-            stop=stop,
-            stream=stream,
+        # Only deterministic completions are cached
+        use_cache = use_cache and temperature == 0
+        cached = (
+            completion_cache.get(model, messages, temperature, stop)
+            if use_cache
+            else None
         )
 
+        stream = True if self.st and write_to_streamlit else False
+        if cached is None:
+            response = openai.ChatCompletion.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                stop=stop,
+                stream=stream,
+            )
+
         if stream:
+            # Cache hits are replayed through the same streaming path
+            if cached is None:
+                chunks = (
+                    chunk.choices[0].delta.get("content", "") for chunk in response
+                )
+            else:
+                chunks = re.findall(r"\S+\s*|\s+", cached)
             with self.st.chat_message("assistant", avatar="🤖"):
                 message_placeholder = self.st.empty()
                 full_response = ""
-                for chunk in response:
-                    full_response += chunk.choices[0].delta.get("content", "")
+                for chunk in chunks:
+                    full_response += chunk
                     message_placeholder.markdown(full_response + "▌")
                 message_placeholder.markdown(full_response)
 
-        else:
+        elif cached is None:
             full_response = response.choices[0].message.content
+        else:
+            full_response = cached
+
+        if use_cache and cached is None:
+            seconds = (timestamp() - start) / 1000
+            completion_cache.set(
+                model, messages, temperature, stop, full_response, seconds
+            )
 
         if self.log:
             self.root_span.add_child(
@@ -103,7 +177,7 @@ class GPT:
                     end_time_ms=timestamp(),
                     inputs=wandb_format_msgs(messages),
                     outputs={"assistant": full_response},
-                    model_dict={"model": model},
+                    model_dict={"model": model, "cached": cached is not None},
                 )
             )
 
@@ -124,6 +198,4 @@ def wandb_format_msgs(msgs):
 
 def num_tokens_from_string(string: str, model: str = "gpt-3.5-turbo") -> int:
     """Returns the number of tokens in a text string."""
-    encoding = tiktoken.encoding_for_model(model)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return tokens.num_tokens(string, model=model)
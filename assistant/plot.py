@@ -1,7 +1,7 @@
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import plotly
-from datetime import timedelta
+from datetime import datetime, timedelta
 import ast
 import pandas as pd
 from assistant.db import crud
@@ -15,37 +15,50 @@ from assistant.config import (
 
 def create(metadata: dict, plots: list[str]) -> str:
     companies = metadata["companies"]
-    _in = dict(company=companies, category=metadata["categories"])
-    df = crud.review.where(
-        _in=_in,
-        cols=["company", "timestamp", "rating", "category"],
+    filters = dict(
+        _in=dict(company=companies, category=metadata["categories"]),
         start_date=metadata["start_date"],
         end_date=metadata["end_date"],
     )
-    if df.empty:
+    # Date filters are answered from the daily rollup, which holds a few rows per
+    # company and day, while filters on exact timestamps need the review table.
+    if is_day_granular(filters["start_date"], filters["end_date"]):
+        source = crud.review_rollup
+    else:
+        source = crud.review
+    start_date, end_date = source.time_range(**filters)
+    if start_date is None:
         return "No data available"
+    freq = set_time_frequence(start_date, end_date)
 
+    # Counts and means are aggregated in the db, so each plot only receives the
+    # aggregated rows it needs, whatever the number of reviews.
     plots_fig = []
     for plot in plots:
         if plot == "ratings time series for single company":
-            fig_data = ratings_time_series(df)
+            df = source.aggregate(freq=freq, **filters)
+            fig_data = ratings_time_series(df, freq=freq)
         elif plot == "ratings piecharts by review category for single company":
+            df = source.aggregate(by=["category"], **filters)
             fig_data = ratings_pie_chart_category(df)
         elif plot == "ratings piechart for single company":
+            df = source.aggregate(**filters)
             fig_data = ratings_pie_chart_total(df)
         elif plot == "ratings and review count time series comparing companies":
-            fig_data = timeseries_compare(df, companies=companies)
+            df = source.aggregate(freq=freq, by=["company"], **filters)
+            fig_data = timeseries_compare(df, companies=companies, freq=freq)
         elif plot == "ratings distribution comparing companies":
+            df = source.aggregate(by=["company"], **filters)
             fig_data = bar_plot_compare(df, companies=companies)
         else:
-            raise ValueError(f"Unknown plot type: {plot_type}")
+            raise ValueError(f"Unknown plot type: {plot}")
 
         plots_fig.append(fig_data)
     return plots_fig
 
 
 def ratings_pie_chart_total(df):
-    ratings = df["rating"].value_counts().sort_index()
+    ratings = star_counts(df)
     fig = go.Figure(layout=dict(margin=dict(t=0, b=0, l=0, r=0)))
     fig.add_trace(
         go.Pie(
@@ -76,7 +89,7 @@ def ratings_pie_chart_category(df):
     dfs = []
     fig = make_subplots(rows=1, cols=N, specs=[[{"type": "domain"}] * N])
     for i, (label, label_val) in enumerate(LABELS):
-        ratings = df[df["category"] == label_val]["rating"].value_counts().sort_index()
+        ratings = star_counts(df[df["category"] == label_val])
         colors = [COLORS[int(rating) - 1] for rating in ratings.index]
         pie_chart = go.Pie(
             values=ratings.values,
@@ -112,10 +125,7 @@ def ratings_pie_chart_category(df):
     return dict(fig=fig, data=dfs, descr=plot_descr)
 
 
-def ratings_time_series(df):
-    start_date, end_date = df["timestamp"].min(), df["timestamp"].max()
-    df = df.set_index("timestamp")
-
+def ratings_time_series(df, freq):
     GRAPH_LAYOUT = dict(
         margin=dict(t=0, b=0, l=0, r=0),
         xaxis=dict(rangeslider=dict(visible=False)),
@@ -140,12 +150,8 @@ def ratings_time_series(df):
     colors = ["#ff9b85", "#ee6055", "#ffd97d", "#aaf683", "#60d394"]
     rating_labels = ["2", "1", "3", "4", "5"]
 
-    time_freq = set_time_frequence(start_date, end_date)
-    ratings_counts = (
-        df.resample(time_freq)["rating"].value_counts().unstack("rating").fillna(0)
-    )
-    ratings_mean = df.resample(time_freq)["rating"].mean()
-    ratings = ratings_mean.to_frame().join(ratings_counts, how="left").fillna(0)
+    ratings = fill_periods(df.set_index("period"), freq)[["mean", *STARS]]
+    ratings = ratings.rename(columns={"mean": "rating"}).loc[:, lambda df: df.any()]
     for rating_label, color in zip(rating_labels, colors):
         rating = int(rating_label)
         if rating in ratings.columns:
@@ -170,9 +176,9 @@ def ratings_time_series(df):
         ),
     )
 
-    if time_freq == "W":
+    if freq == "W":
         fig = fig.update_layout(xaxis=dict(title_text="Uge"))
-    elif time_freq == "D":
+    elif freq == "D":
         fig = fig.update_layout(xaxis=dict(title_text="Dag"))
     else:
         pass
@@ -194,22 +200,20 @@ def ratings_time_series(df):
     return dict(fig=fig, data=ratings, descr=plot_descr)
 
 
-def timeseries_compare(df, companies):
-    start_date, end_date = df["timestamp"].min(), df["timestamp"].max()
-    df = df.set_index("timestamp")
+def timeseries_compare(df, companies, freq):
     if df.empty:
         return go.Figure()
+    periods = period_range(df["period"], freq)
 
     colors = plotly.colors.qualitative.T10
     COLORS = LABEL_COLORS
-    freq = set_time_frequence(start_date, end_date)
     fig = make_subplots(rows=2, cols=1, shared_xaxes=True)
     # Add mean and count time series plots
     data = {}
     i = 0
     for company in companies:
-        df_t = df.loc[df["company"] == company, "rating"]
-        df_t = df_t.resample(freq).agg(["mean", "count"]).fillna(0)
+        df_t = df.loc[df["company"] == company].set_index("period")
+        df_t = df_t[["mean", "count"]].reindex(periods, fill_value=0)
         fig.add_trace(
             go.Scatter(
                 x=df_t.index,
@@ -267,6 +271,7 @@ def timeseries_compare(df, companies):
 
 
 def bar_plot_compare(df_r, companies):
+    df_r = df_r.set_index("company")
     GRAPH_LAYOUT = dict(
         margin=dict(t=0, b=0, l=0, r=0), xaxis=dict(zeroline=True, showgrid=True)
     )
@@ -283,22 +288,17 @@ def bar_plot_compare(df_r, companies):
     colors = ["#ee6055", "#ff9b85", "#ffd97d", "#aaf683", "#60d394"]
     rating_labels = ["1", "2", "3", "4", "5"]
     for company in companies:
-        df_t = (
-            df_r.loc[df_r["company"] == company, "rating"]
-            .value_counts()
-            .reset_index()
-            .assign(pct=lambda df: df["count"] / df["count"].sum())
-        )
-        agg_stats = df_r.loc[df_r["company"] == company, "rating"].agg(
-            ["mean", "count"]
-        )
-        x_axis_name = f"{company} <br> ☆{agg_stats['mean'].round(2)} <br> #{int(agg_stats['count'])}"
+        if company not in df_r.index:
+            continue
+        agg_stats = df_r.loc[company]
+        df_t = star_counts(df_r.loc[[company]]).to_frame()
+        df_t["pct"] = df_t["count"] / df_t["count"].sum()
+        x_axis_name = f"{company} <br> ☆{round(agg_stats['mean'], 2)} <br> #{int(agg_stats['count'])}"
         for rating_label, color in zip(rating_labels, colors):
             rating = int(rating_label)
-            df_rating = df_t[df_t["rating"] == rating].copy()
-
-            if df_rating.empty:
+            if rating not in df_t.index:
                 continue
+            df_rating = df_t.loc[[rating]]
 
             fig.add_trace(
                 go.Bar(
@@ -316,14 +316,8 @@ def bar_plot_compare(df_r, companies):
             )
 
     # Create dataframe used to describe plot
-    df = (
-        df_r.drop("category", axis=1)
-        .groupby("company")["rating"]
-        .value_counts()
-        .unstack(1)
-        .fillna(0)
-    )
-    star_cols = [c for c in df.columns if c in list(range(6))]
+    df = df_r[STARS].loc[:, lambda df: df.any()]
+    star_cols = list(df.columns)
     df[star_cols] = (df[star_cols] / df.sum(axis=1).values.reshape(-1, 1) * 100).round(
         1
     )
@@ -342,3 +336,32 @@ def set_time_frequence(start_date, end_date):
     else:
         time_freq = "M"
     return time_freq
+
+
+def is_day_granular(*dates) -> bool:
+    """True if all dates are unset or whole days rather than timestamps."""
+    return all(not d or not isinstance(d, datetime) for d in dates)
+
+
+def star_counts(df):
+    """Number of reviews per star rating, leaving out ratings without reviews."""
+    ratings = df[STARS].sum().astype(int)
+    ratings = ratings[ratings > 0]
+    ratings.index.name = "rating"
+    return ratings.rename("count")
+
+
+def period_range(periods, freq):
+    # date_trunc labels weeks by their monday and months by their first day
+    return pd.date_range(
+        periods.min(), periods.max(), freq=PERIOD_FREQ[freq], name="period"
+    )
+
+
+def fill_periods(df, freq):
+    """Add the periods without reviews, which the aggregate query leaves out."""
+    return df.reindex(period_range(df.index, freq), fill_value=0)
+
+
+STARS = [1, 2, 3, 4, 5]
+PERIOD_FREQ = {"D": "D", "W": "W-MON", "M": "MS"}
@@ -1,4 +1,3 @@
-import pandas as pd
 from copy import deepcopy
 import openai
 import json
@@ -7,6 +6,14 @@ from json.decoder import JSONDecodeError
 from datetime import datetime
 from assistant.config import CATEGORY_INT2STR
 from assistant.db import crud
+from assistant.llm import timestamp
+from concurrent.futures import ThreadPoolExecutor
+from wandb.sdk.data_types.trace_tree import Trace
+
+# Max rows of a SQL query result passed on to the analysis
+SQL_MAX_ROWS = 20
+# Max questions of a SQL step generated and run at the same time
+SQL_MAX_WORKERS = 4
 
 
 def sql(queries, metadata, gpt) -> str:
@@ -17,9 +24,28 @@ def sql(queries, metadata, gpt) -> str:
         [f"{k} in {tuple(v)}" for k, v in metadata.items() if v]
     )
 
-    queries_result = []
-    for query in queries:
-        # Get ChatGPT to create sql query
+    # Generate and run the SQL for each question on a bounded pool. map returns
+    # the results in the order of the questions.
+    with ThreadPoolExecutor(max_workers=SQL_MAX_WORKERS) as pool:
+        queries_result = list(
+            pool.map(
+                lambda query: sql_answer(
+                    query, filters_stmt, start_date, end_date, gpt
+                ),
+                queries,
+            )
+        )
+    return queries_result
+
+
+def sql_answer(query, filters_stmt, start_date, end_date, gpt) -> dict:
+    """
+    Get ChatGPT to create a sql query for the question and run it. An error only
+    fails this question: it is returned as SQLError for the analysis to see.
+    """
+    start = timestamp()
+    sql_query = None
+    try:
         chatgpt_query = SQL_QUERY_PROMPT.render(
             question=query,
             filters=filters_stmt,
@@ -37,14 +63,28 @@ def sql(queries, metadata, gpt) -> str:
         sql_query = sql_query.strip(' "\n')
 
         # Execute sql query and return result
-        df = crud.exec_sql(sql_query)
-        queries_result.append(
-            dict(
-                SQLQuery=sql_query,
-                SQLResult=df.head(20).astype(str).to_dict("records"),
+        df, info = crud.exec_agent_sql(sql_query, max_rows=SQL_MAX_ROWS)
+        result = dict(
+            SQLQuery=sql_query,
+            SQLResult=df.astype(str).to_dict("records"),
+            Truncated=info["truncated"],
+            ElapsedSeconds=round(info["elapsed"], 2),
+        )
+    except Exception as e:
+        result = dict(SQLQuery=sql_query, SQLError=str(e))
+
+    if gpt.log:
+        gpt.root_span.add_child(
+            Trace(
+                name="SQL task",
+                kind="tool",
+                start_time_ms=start,
+                end_time_ms=timestamp(),
+                inputs={"question": query},
+                outputs={"result": json.dumps(result, ensure_ascii=False)},
             )
         )
-    return queries_result
+    return result
 
 
 def data(queries, metadata):
@@ -55,12 +95,7 @@ def data(queries, metadata):
         start_date=metadata["start_date"],
         end_date=metadata["end_date"],
     )
-    df = []
-    for query in queries:
-        df_t = crud.review.where(similarity_query=query, **params)
-        df_t["similarity_query"] = query
-        df.append(df_t)
-    df = pd.concat(df)
+    df = crud.review.where_many(similarity_queries=queries, **params)
     if not df.empty:
         df["category"] = df["category"].apply(lambda x: CATEGORY_INT2STR[x])
     return df
@@ -88,6 +123,15 @@ timestamp: datetime. The timestamp of the review.
 category: Review category.
 company: The company that the review is about.
 
+For counts and average ratings it is much faster to use the table reviewrollup, where each row holds the number of reviews and ratings for a company, category and day. The table reviewrollup has the following columns:
+
+company: The company that the reviews are about.
+category: Review category.
+day: date. The day the reviews were written. Use day instead of timestamp in date filters.
+n_reviews: integer. The number of reviews.
+rating_sum: integer. The sum of the ratings. The average rating is sum(rating_sum)::float / sum(n_reviews).
+n_1, n_2, n_3, n_4, n_5: integer. The number of reviews with rating 1, 2, 3, 4 and 5.
+
 {% if filters -%}
 Add the following filters to the query:
 {{ filters}}
@@ -0,0 +1,109 @@
+import re
+import time
+import numpy as np
+import pandas as pd
+from typing import Optional
+from assistant.db import crud, models
+from assistant.llm import embed
+
+
+class CompanyNameResolver:
+    def __init__(self, crud_company, max_age: int = 300, min_similarity=0.5):
+        """
+        Resolves company names mentioned by users to company names in the db.
+
+        The company table is small, so it is loaded once per process together with
+        the company name embeddings. Names are matched by normalized exact, prefix
+        and trigram matching, and names without a match are resolved to the
+        nearest company embedding in a single embed call and matrix product.
+
+        **Parameters**
+
+        * `crud_company`: The company CRUD object
+        * `max_age`: Seconds before reloading, to pick up writes from other processes
+        * `min_similarity`: Min trigram Jaccard similarity to accept a match
+        """
+        self.crud = crud_company
+        self.max_age = max_age
+        self.min_similarity = min_similarity
+        self.version = None
+        self.loaded_at = 0
+
+    def resolve(self, names: list[str]) -> list[str]:
+        self.refresh()
+        resolved = [self.match_text(name) for name in names]
+
+        unresolved = [i for i, name in enumerate(resolved) if name is None]
+        if unresolved and len(self.embeddings):
+            query_embs = np.array(embed([names[i] for i in unresolved]))
+            # Squared L2 distances between every query and every company
+            dists = (
+                (query_embs**2).sum(axis=1)[:, None]
+                - 2 * query_embs @ self.embeddings.T
+                + self.embedding_norms[None, :]
+            )
+            for i, j in zip(unresolved, dists.argmin(axis=1)):
+                resolved[i] = self.embedding_names[j]
+        return resolved
+
+    def match_text(self, name: str) -> Optional[str]:
+        query = normalize(name)
+        if not query:
+            return None
+        if query in self.exact:
+            return self.exact[query]
+
+        prefix_matches = [
+            (len(norm_name), company_name)
+            for norm_name, company_name in self.exact.items()
+            if min(len(norm_name), len(query)) >= 3
+            and (norm_name.startswith(query) or query.startswith(norm_name))
+        ]
+        if prefix_matches:
+            return min(prefix_matches)[1]
+
+        query_trigrams = trigrams(query)
+        best_similarity, best_name = 0, None
+        for company_trigrams, company_name in self.trigrams:
+            similarity = len(query_trigrams & company_trigrams) / len(
+                query_trigrams | company_trigrams
+            )
+            if similarity > best_similarity:
+                best_similarity, best_name = similarity, company_name
+        return best_name if best_similarity >= self.min_similarity else None
+
+    def refresh(self) -> None:
+        if (
+            self.version == self.crud.version
+            and time.time() - self.loaded_at < self.max_age
+        ):
+            return
+
+        self.version = self.crud.version
+        df = self.crud.get_table(cols=["name", "embedding"])
+        if df.empty:
+            df = pd.DataFrame(columns=["name", "embedding"])
+        self.exact = {normalize(name): name for name in df["name"]}
+        self.trigrams = [(trigrams(norm), name) for norm, name in self.exact.items()]
+
+        df = df[df["embedding"].notna()]
+        self.embedding_names = df["name"].to_list()
+        if len(df):
+            self.embeddings = np.array(df["embedding"].to_list(), dtype=np.float32)
+            self.embedding_norms = (self.embeddings**2).sum(axis=1)
+        else:
+            self.embeddings = np.empty((0, models.EMBEDDING_DIM), dtype=np.float32)
+            self.embedding_norms = np.empty(0, dtype=np.float32)
+        self.loaded_at = time.time()
+
+
+def normalize(name: str) -> str:
+    return " ".join(re.sub(r"[^\w]+", " ", name.lower()).split())
+
+
+def trigrams(text: str) -> set[str]:
+    text = f"  {text} "
+    return {text[i : i + 3] for i in range(len(text) - 2)}
+
+
+company_names = CompanyNameResolver(crud.company)
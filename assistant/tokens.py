@@ -0,0 +1,57 @@
+import tiktoken
+import numpy as np
+import pandas as pd
+from functools import lru_cache
+from typing import Union
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-3.5-turbo") -> tiktoken.Encoding:
+    """Encoder of `model`, loaded once per process."""
+    return tiktoken.encoding_for_model(model)
+
+
+def num_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    return len(get_encoding(model).encode_ordinary(text))
+
+
+def encode_batch(
+    texts: Union[pd.Series, list[str]], model: str = "gpt-3.5-turbo"
+) -> list[list[int]]:
+    """
+    Tokenize all texts in one call, which tiktoken spreads over threads. Special
+    tokens in the texts are encoded as ordinary text.
+    """
+    return get_encoding(model).encode_ordinary_batch(list(texts))
+
+
+def count_tokens(
+    texts: Union[pd.Series, list[str]], model: str = "gpt-3.5-turbo"
+) -> pd.Series:
+    """Number of tokens of each text, indexed like `texts` if it is a Series."""
+    counts = [len(tokens) for tokens in encode_batch(texts, model=model)]
+    index = texts.index if isinstance(texts, pd.Series) else None
+    return pd.Series(counts, index=index, dtype=int)
+
+
+def pack(token_counts: pd.Series, max_tokens: int, overhead: int = 0) -> pd.Index:
+    """
+    Index of the texts that fit within `max_tokens`, taken greedily in the order
+    of `token_counts`: a text that doesn't fit is skipped and smaller texts after
+    it can still fill the budget. `overhead` tokens are counted per text, e.g. for
+    the separators between texts in a prompt.
+
+    **Parameters**
+
+    * `token_counts`: Number of tokens of each text, e.g. from `count_tokens`
+    * `max_tokens`: The token budget
+    * `overhead`: Extra tokens per text
+    """
+    costs = token_counts.to_numpy() + overhead
+    keep = np.zeros(len(costs), dtype=bool)
+    remaining = max_tokens
+    for i, cost in enumerate(costs):
+        if cost <= remaining:
+            keep[i] = True
+            remaining -= cost
+    return token_counts.index[keep]
@@ -0,0 +1,134 @@
+"""
+Benchmark filtered similarity search on a partitioned table against a single
+table with a global vector index: latency and recall@k per filter selectivity.
+
+Loads `--rows` clustered random vectors spread evenly over `--groups` groups
+(standing in for companies) into a plain table with one HNSW index and into a
+table LIST partitioned by group with an HNSW index per partition. Queries
+filter on the groups covering each `--selectivities` share of the rows.
+
+	python scripts/bench_filtered_search.py --rows 1000000 --groups 100
+"""
+import io
+import struct
+import argparse
+import numpy as np
+from time import perf_counter
+from assistant.db.db import engine
+from assistant.db.models import VECTOR_OPS, EMBEDDING_DISTANCE, DISTANCE_OPERATORS
+from bench_vector_index import random_vectors, report
+
+TABLE = "bench_filtered"
+PARTITIONED_TABLE = "bench_filtered_partitioned"
+
+
+def copy_rows(cursor, table, groups, vectors):
+	"""COPY (grp, embedding) rows in the binary format."""
+	buf = io.BytesIO()
+	buf.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+	dim = vectors.shape[1]
+	for group, vector in zip(groups, vectors):
+		buf.write(struct.pack(">hii", 2, 4, group))
+		buf.write(struct.pack(">iHH", 4 + 4 * dim, dim, 0))
+		buf.write(vector.astype(">f4").tobytes())
+	buf.write(struct.pack(">h", -1))
+	buf.seek(0)
+	cursor.copy_expert(
+	 f"COPY {table} (grp, embedding) FROM STDIN WITH (FORMAT binary)", buf)
+
+
+def load(conn, rows, dim, n_groups, rng, batch_size=50_000):
+	centers = rng.normal(size=(1000, dim))
+	ops = VECTOR_OPS[EMBEDDING_DISTANCE]
+	with conn.cursor() as cursor:
+		for table in [TABLE, PARTITIONED_TABLE]:
+			cursor.execute(f"DROP TABLE IF EXISTS {table}")
+		cursor.execute(f"CREATE TABLE {TABLE} (id bigserial, grp int, "
+		               f"embedding vector({dim}))")
+		cursor.execute(f"CREATE TABLE {PARTITIONED_TABLE} (LIKE {TABLE}) "
+		               "PARTITION BY LIST (grp)")
+		for group in range(n_groups):
+			cursor.execute(f"CREATE TABLE {PARTITIONED_TABLE}_{group} PARTITION OF "
+			               f"{PARTITIONED_TABLE} FOR VALUES IN ({group})")
+
+		for i in range(0, rows, batch_size):
+			n = min(batch_size, rows - i)
+			groups = rng.integers(n_groups, size=n)
+			vectors = random_vectors(n, dim, centers, rng)
+			for table in [TABLE, PARTITIONED_TABLE]:
+				copy_rows(cursor, table, groups, vectors)
+
+		for table in [TABLE, PARTITIONED_TABLE]:
+			start = perf_counter()
+			cursor.execute(f"CREATE INDEX ON {table} USING hnsw (embedding {ops}) "
+			               "WITH (m = 16, ef_construction = 64)")
+			cursor.execute(f"CREATE INDEX ON {table} (grp)")
+			print(f"{table} indexed in {perf_counter() - start:.0f}s")
+			cursor.execute(f"ANALYZE {table}")
+	conn.commit()
+	return centers
+
+
+def search(conn, table, queries, groups, k, settings):
+	operator = DISTANCE_OPERATORS[EMBEDDING_DISTANCE]
+	results, latencies = [], []
+	with conn.cursor() as cursor:
+		for setting in settings:
+			cursor.execute(setting)
+		for query in queries:
+			start = perf_counter()
+			# Literal group ids, so partitions are pruned when planning
+			cursor.execute(
+			 f"SELECT id FROM {table} WHERE grp IN ({', '.join(map(str, groups))}) "
+			 f"ORDER BY embedding {operator} %s::vector LIMIT {k}",
+			 (str(query.tolist()), ))
+			results.append({row[0] for row in cursor.fetchall()})
+			latencies.append((perf_counter() - start) * 1000)
+	conn.rollback()
+	return results, np.array(latencies)
+
+
+def main(rows, dim, n_groups, n_queries, k, selectivities, ef_search, reuse):
+	rng = np.random.default_rng(0)
+	conn = engine.raw_connection()
+	if reuse:
+		centers = rng.normal(size=(1000, dim))
+	else:
+		centers = load(conn, rows, dim, n_groups, rng)
+	queries = random_vectors(n_queries, dim, centers, rng)
+
+	for selectivity in selectivities:
+		groups = list(range(max(int(selectivity * n_groups), 1)))
+		print(f"\nselectivity {len(groups) / n_groups:.1%}")
+		exact, latencies = search(conn, TABLE, queries, groups, k, [
+		 "SET LOCAL enable_indexscan = off",
+		 "SET LOCAL max_parallel_workers_per_gather = 0",
+		])
+		report("exact", latencies)
+		for table in [TABLE, PARTITIONED_TABLE]:
+			results, latencies = search(conn, table, queries, groups, k,
+			                            [f"SET LOCAL hnsw.ef_search = {ef_search}"])
+			report("partitioned" if table == PARTITIONED_TABLE else "global index",
+			       latencies, results, exact)
+	conn.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rows", type=int, default=1_000_000)
+	parser.add_argument("--dim", type=int, default=768)
+	parser.add_argument("--groups", type=int, default=100)
+	parser.add_argument("--queries", type=int, default=50)
+	parser.add_argument("--k", type=int, default=10)
+	parser.add_argument("--selectivities",
+	                    type=float,
+	                    nargs="+",
+	                    default=[0.5, 0.1, 0.01])
+	parser.add_argument("--ef-search", type=int, default=40)
+	parser.add_argument("--reuse",
+	                    action="store_true",
+	                    help="Reuse the tables and indexes of the previous run")
+	args = parser.parse_args()
+
+	main(args.rows, args.dim, args.groups, args.queries, args.k,
+	     args.selectivities, args.ef_search, args.reuse)
@@ -0,0 +1,62 @@
+"""
+Micro-benchmark of the fast JSON payload extraction against the full
+BeautifulSoup parse over saved Trustpilot pages.
+
+Save fixture pages first, then benchmark them:
+
+	python scripts/bench_page_parsing.py --download https://trustpilot.com/review/danskebank.dk
+	python scripts/bench_page_parsing.py
+"""
+import argparse
+from pathlib import Path
+from time import perf_counter
+from urllib.parse import urlparse
+import requests
+from trustpilot_parsing import parse_page_fast, parse_page_soup
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+
+
+def download(urls, fixtures_dir=FIXTURES_DIR):
+	fixtures_dir.mkdir(parents=True, exist_ok=True)
+	for url in urls:
+		path = fixtures_dir / (urlparse(url).path.strip("/").replace("/", "_") +
+		                       ".html")
+		path.write_bytes(requests.get(url).content)
+		print(f"Saved {url} to {path}")
+
+
+def benchmark(pages, parse, repeat):
+	start = perf_counter()
+	for _ in range(repeat):
+		for html in pages:
+			parse(html)
+	return len(pages) * repeat / (perf_counter() - start)
+
+
+def main(fixtures_dir=FIXTURES_DIR, repeat=5):
+	pages = [path.read_bytes() for path in sorted(fixtures_dir.glob("*.html"))]
+	if not pages:
+		raise SystemExit(f"No fixtures in {fixtures_dir}, save some with --download")
+
+	for html in pages:
+		fast, soup = parse_page_fast(html), parse_page_soup(html)
+		assert fast["reviews"] == soup["reviews"]
+		assert fast["next_page_url"] == soup["next_page_url"]
+
+	print(f"{len(pages)} pages, {sum(map(len, pages)) / len(pages) / 1e3:.0f} KB avg")
+	for name, parse in [("fast", parse_page_fast), ("soup", parse_page_soup)]:
+		print(f"{name}: {benchmark(pages, parse, repeat):.1f} pages/s")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--download", nargs="+", help="Save pages as fixtures")
+	parser.add_argument("--fixtures", type=Path, default=FIXTURES_DIR)
+	parser.add_argument("--repeat", type=int, default=5)
+	args = parser.parse_args()
+
+	if args.download:
+		download(args.download, args.fixtures)
+	else:
+		main(args.fixtures, args.repeat)
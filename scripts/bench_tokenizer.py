@@ -0,0 +1,78 @@
+"""
+Benchmark tokenizing review texts: reviews tokenized per second when loading the
+encoder on every call (the old `num_tokens_from_string`), with the encoder
+cached per process (`tokens.num_tokens`) and batched over all reviews
+(`tokens.count_tokens`).
+
+Tokenizes the content of `--reviews` reviews from the db, or synthetic texts
+with `--synthetic`.
+
+	python scripts/bench_tokenizer.py --reviews 10000
+	python scripts/bench_tokenizer.py --reviews 10000 --synthetic
+"""
+import argparse
+import tiktoken
+import numpy as np
+from time import perf_counter
+from assistant import tokens
+
+WORDS = ("great service fast delivery the product arrived broken and customer "
+         "support never answered my emails would recommend to anyone").split()
+
+
+def synthetic_texts(n, rng):
+	lengths = rng.integers(5, 200, size=n)
+	return [" ".join(rng.choice(WORDS, size=length)) for length in lengths]
+
+
+def review_texts(n):
+	from assistant.db import crud
+	df = crud.review.where(cols=["content"], limit=n, use_cache=False)
+	return df["content"].fillna("").to_list()
+
+
+def uncached(texts, model):
+	return [len(tiktoken.encoding_for_model(model).encode_ordinary(text)) for text in texts]
+
+
+def cached(texts, model):
+	return [tokens.num_tokens(text, model=model) for text in texts]
+
+
+def batched(texts, model):
+	return tokens.count_tokens(texts, model=model).to_list()
+
+
+def main(n, model, synthetic, repeats):
+	if synthetic:
+		texts = synthetic_texts(n, np.random.default_rng(0))
+	else:
+		texts = review_texts(n)
+	tokens.get_encoding(model)  # Load the BPE ranks before timing
+	expected = None
+	for name, count in [("uncached", uncached), ("cached", cached),
+	                    ("batched", batched)]:
+		seconds = []
+		for _ in range(repeats):
+			start = perf_counter()
+			counts = count(texts, model)
+			seconds.append(perf_counter() - start)
+		expected = expected or counts
+		assert counts == expected, f"{name} token counts differ"
+		best = min(seconds)
+		print(f"{name:>10}: {len(texts) / best:>10,.0f} reviews/s  "
+		      f"({best * 1000:.0f}ms for {len(texts)} reviews, "
+		      f"{sum(counts):,} tokens)")
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--reviews", type=int, default=10_000)
+	parser.add_argument("--model", default="gpt-4")
+	parser.add_argument("--synthetic",
+	                    action="store_true",
+	                    help="Tokenize synthetic texts instead of reviews from the db")
+	parser.add_argument("--repeats", type=int, default=3)
+	args = parser.parse_args()
+
+	main(args.reviews, args.model, args.synthetic, args.repeats)
@@ -0,0 +1,171 @@
+"""
+Benchmark ANN vector indexes against exact search: latency and recall@k.
+
+Loads `--rows` clustered random vectors into a scratch table, builds an HNSW or
+IVFFlat index and compares search with several ef_search / probes settings with
+an exact sequential scan over the same queries.
+
+With `--quantization` the index is built on the half precision or binary
+quantized vectors and `--rerank` * k candidates are re-ranked by their exact
+distance, like `crud.where(quantization=...)`. Compare the table and index sizes,
+latency and recall with a run without quantization.
+
+	python scripts/bench_vector_index.py --rows 1000000 --method hnsw
+	python scripts/bench_vector_index.py --rows 1000000 --method ivfflat
+	python scripts/bench_vector_index.py --rows 1000000 --quantization binary
+"""
+import io
+import struct
+import argparse
+import numpy as np
+from time import perf_counter
+from assistant.db.db import engine
+from assistant.db.models import (VECTOR_OPS, EMBEDDING_DISTANCE,
+                                 DISTANCE_OPERATORS, QUANTIZED_EMBEDDING,
+                                 QUANTIZED_OPS)
+
+TABLE = "bench_embedding"
+INDEX = f"{TABLE}_embedding_idx"
+
+
+def random_vectors(n, dim, centers, rng):
+	"""Vectors around random cluster centers, which ANN indexes rely on."""
+	labels = rng.integers(len(centers), size=n)
+	return (centers[labels] + rng.normal(scale=0.3, size=(n, dim))).astype(
+	 np.float32)
+
+
+def copy_vectors(cursor, vectors):
+	"""COPY vectors in the binary format of pgvector's vector type."""
+	buf = io.BytesIO()
+	buf.write(b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0))
+	dim = vectors.shape[1]
+	for vector in vectors:
+		buf.write(struct.pack(">hiHH", 1, 4 + 4 * dim, dim, 0))
+		buf.write(vector.astype(">f4").tobytes())
+	buf.write(struct.pack(">h", -1))
+	buf.seek(0)
+	cursor.copy_expert(f"COPY {TABLE} (embedding) FROM STDIN WITH (FORMAT binary)",
+	                   buf)
+
+
+def load(conn, rows, dim, rng, batch_size=50_000):
+	centers = rng.normal(size=(1000, dim))
+	with conn.cursor() as cursor:
+		cursor.execute(f"DROP TABLE IF EXISTS {TABLE}")
+		cursor.execute(
+		 f"CREATE TABLE {TABLE} (id bigserial PRIMARY KEY, embedding vector({dim}))")
+		for i in range(0, rows, batch_size):
+			copy_vectors(cursor,
+			             random_vectors(min(batch_size, rows - i), dim, centers, rng))
+	conn.commit()
+	return centers
+
+
+def build_index(conn, method, quantization=None, dim=768):
+	if quantization:
+		expression = QUANTIZED_EMBEDDING[quantization].replace("768", str(dim))
+		ops = QUANTIZED_OPS[quantization][EMBEDDING_DISTANCE]
+	else:
+		expression, ops = "embedding", VECTOR_OPS[EMBEDDING_DISTANCE]
+	with conn.cursor() as cursor:
+		cursor.execute(f"DROP INDEX IF EXISTS {INDEX}")
+		cursor.execute(f"SELECT count(*) FROM {TABLE}")
+		n_rows = cursor.fetchone()[0]
+		params = ("m = 16, ef_construction = 64" if method == "hnsw" else
+		          f"lists = {max(n_rows // 1000, 1)}")
+		start = perf_counter()
+		cursor.execute(f"CREATE INDEX {INDEX} ON {TABLE} "
+		               f"USING {method} ({expression} {ops}) WITH ({params})")
+		conn.commit()
+		build_time = perf_counter() - start
+		cursor.execute(
+		 f"SELECT pg_table_size('{TABLE}'), pg_relation_size('{INDEX}')")
+		table_size, index_size = cursor.fetchone()
+	print(f"{method} {quantization or 'float32'} index on {n_rows} rows built in "
+	      f"{build_time:.0f}s, table {table_size / 1e6:.0f} MB, "
+	      f"index {index_size / 1e6:.0f} MB")
+
+
+def search(conn, queries, k, settings, quantization=None, rerank=4, dim=768):
+	operator = DISTANCE_OPERATORS[EMBEDDING_DISTANCE]
+	sql = f"SELECT id FROM {TABLE} ORDER BY embedding {operator} %(q)s::vector LIMIT {k}"
+	if quantization:
+		expression = QUANTIZED_EMBEDDING[quantization].replace("768", str(dim))
+		query = expression.replace("embedding", "%(q)s::vector")
+		quantized_operator = "<~>" if quantization == "binary" else operator
+		sql = (f"SELECT id FROM (SELECT id, embedding {operator} %(q)s::vector AS d "
+		       f"FROM {TABLE} ORDER BY {expression} {quantized_operator} {query} "
+		       f"LIMIT {k * rerank}) c ORDER BY d LIMIT {k}")
+	results, latencies = [], []
+	with conn.cursor() as cursor:
+		for setting in settings:
+			cursor.execute(setting)
+		for query in queries:
+			start = perf_counter()
+			cursor.execute(sql, dict(q=str(query.tolist())))
+			results.append({row[0] for row in cursor.fetchall()})
+			latencies.append((perf_counter() - start) * 1000)
+	conn.rollback()
+	return results, np.array(latencies)
+
+
+def report(name, latencies, results=None, exact=None):
+	line = (f"{name:<22} p50 {np.percentile(latencies, 50):8.1f} ms   "
+	        f"p95 {np.percentile(latencies, 95):8.1f} ms")
+	if exact is not None:
+		recall = np.mean([len(r & e) / len(e) for r, e in zip(results, exact)])
+		line += f"   recall {recall:.3f}"
+	print(line)
+
+
+def main(rows, dim, n_queries, k, method, values, reuse, quantization, rerank):
+	rng = np.random.default_rng(0)
+	conn = engine.raw_connection()
+	if reuse:
+		centers = rng.normal(size=(1000, dim))
+	else:
+		centers = load(conn, rows, dim, rng)
+		build_index(conn, method, quantization, dim)
+	queries = random_vectors(n_queries, dim, centers, rng)
+
+	exact, latencies = search(conn, queries, k, [
+	 "SET LOCAL enable_indexscan = off",
+	 "SET LOCAL max_parallel_workers_per_gather = 0",
+	])
+	report("exact", latencies)
+
+	setting = "hnsw.ef_search" if method == "hnsw" else "ivfflat.probes"
+	for value in values:
+		results, latencies = search(conn, queries, k,
+		                            [f"SET LOCAL {setting} = {value}"],
+		                            quantization, rerank, dim)
+		report(f"{setting}={value}", latencies, results, exact)
+	conn.close()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--rows", type=int, default=1_000_000)
+	parser.add_argument("--dim", type=int, default=768)
+	parser.add_argument("--queries", type=int, default=50)
+	parser.add_argument("--k", type=int, default=10)
+	parser.add_argument("--method", choices=["hnsw", "ivfflat"], default="hnsw")
+	parser.add_argument("--values",
+	                    type=int,
+	                    nargs="+",
+	                    help="ef_search (hnsw) or probes (ivfflat) values to try")
+	parser.add_argument("--quantization", choices=["half", "binary"])
+	parser.add_argument("--rerank",
+	                    type=int,
+	                    default=4,
+	                    help="Candidates per result re-ranked by exact distance")
+	parser.add_argument("--reuse",
+	                    action="store_true",
+	                    help="Reuse the table and index of the previous run")
+	args = parser.parse_args()
+
+	values = args.values or ([20, 40, 100, 200] if args.method == "hnsw" else
+	                         [1, 5, 10, 40])
+	main(args.rows, args.dim, args.queries, args.k, args.method, values,
+	     args.reuse, args.quantization, args.rerank)
@@ -0,0 +1,134 @@
+import os
+import json
+import sqlite3
+from time import time
+
+
+class CrawlFrontier:
+	"""
+	Persistent crawl frontier stored in a local SQLite file, with one item per
+	company holding the url of the next page to crawl. Worker processes lease
+	items, checkpoint the next page url after every page and finally mark items
+	done or failed. Failed items are retried with exponential backoff, and items
+	whose lease expires (e.g. the worker died) can be leased by another worker.
+	"""
+
+	def __init__(self,
+	             path=".cache/crawl_frontier.sqlite",
+	             lease_seconds=600,
+	             max_attempts=5,
+	             backoff_seconds=60):
+		if os.path.dirname(path):
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+		self.lease_seconds = lease_seconds
+		self.max_attempts = max_attempts
+		self.backoff_seconds = backoff_seconds
+		self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+		self.conn.row_factory = sqlite3.Row
+		self.conn.execute("PRAGMA journal_mode=WAL")
+		self.conn.execute("""CREATE TABLE IF NOT EXISTS frontier (
+			company_id INTEGER PRIMARY KEY,
+			company TEXT NOT NULL,
+			watermark TEXT,
+			next_page_url TEXT,
+			pages INTEGER NOT NULL DEFAULT 0,
+			status TEXT NOT NULL DEFAULT 'pending',
+			attempts INTEGER NOT NULL DEFAULT 0,
+			available_at REAL NOT NULL DEFAULT 0,
+			error TEXT
+		)""")
+
+	def seed(self, companies, watermarks={}, base_url="https://trustpilot.com"):
+		"""Replace the frontier with a fresh crawl of `companies`."""
+		with self.transaction():
+			self.conn.execute("DELETE FROM frontier")
+			self.conn.executemany(
+			 "INSERT INTO frontier (company_id, company, watermark, next_page_url) "
+			 "VALUES (?, ?, ?, ?)",
+			 [(
+			  int(company["id"]),
+			  json.dumps(dict(id=int(company["id"]),
+			                  name=company["name"],
+			                  homepage=company["homepage"])),
+			  watermarks[company["id"]].isoformat()
+			  if company["id"] in watermarks else None,
+			  f"{base_url}/review/{company['homepage']}",
+			 ) for company in companies],
+			)
+
+	def lease(self):
+		"""Lease the next available item, or return None if nothing is available."""
+		now = time()
+		with self.transaction():
+			row = self.conn.execute(
+			 "SELECT * FROM frontier WHERE status IN ('pending', 'leased') "
+			 "AND available_at <= ? ORDER BY available_at LIMIT 1",
+			 (now, ),
+			).fetchone()
+			if row is None:
+				return None
+			self.conn.execute(
+			 "UPDATE frontier SET status = 'leased', available_at = ? "
+			 "WHERE company_id = ?",
+			 (now + self.lease_seconds, row["company_id"]),
+			)
+		item = dict(row)
+		item["company"] = json.loads(item["company"])
+		return item
+
+	def checkpoint(self, company_id, next_page_url):
+		"""Record a crawled page and extend the lease."""
+		self.conn.execute(
+		 "UPDATE frontier SET next_page_url = ?, pages = pages + 1, "
+		 "available_at = ? WHERE company_id = ?",
+		 (next_page_url, time() + self.lease_seconds, company_id),
+		)
+
+	def done(self, company_id):
+		self.conn.execute(
+		 "UPDATE frontier SET status = 'done', error = NULL WHERE company_id = ?",
+		 (company_id, ))
+
+	def fail(self, company_id, error):
+		with self.transaction():
+			attempts = self.conn.execute(
+			 "SELECT attempts FROM frontier WHERE company_id = ?",
+			 (company_id, )).fetchone()["attempts"] + 1
+			status = "failed" if attempts >= self.max_attempts else "pending"
+			available_at = time() + self.backoff_seconds * 2**(attempts - 1)
+			self.conn.execute(
+			 "UPDATE frontier SET status = ?, attempts = ?, available_at = ?, "
+			 "error = ? WHERE company_id = ?",
+			 (status, attempts, available_at, error, company_id),
+			)
+
+	def release_leases(self):
+		"""Make items leased by workers of a previous run available again."""
+		self.conn.execute("UPDATE frontier SET status = 'pending', available_at = 0 "
+		                  "WHERE status = 'leased'")
+
+	def is_finished(self):
+		row = self.conn.execute("SELECT count(*) FROM frontier "
+		                        "WHERE status IN ('pending', 'leased')").fetchone()
+		return row[0] == 0
+
+	def counts(self):
+		rows = self.conn.execute(
+		 "SELECT status, count(*) FROM frontier GROUP BY status").fetchall()
+		return {status: n for status, n in rows}
+
+	def transaction(self):
+		return Transaction(self.conn)
+
+
+class Transaction:
+	"""Write transaction taking the database lock up front, so leases never race."""
+
+	def __init__(self, conn):
+		self.conn = conn
+
+	def __enter__(self):
+		self.conn.execute("BEGIN IMMEDIATE")
+
+	def __exit__(self, exc_type, exc, tb):
+		self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,74 @@
+import re, json
+from html import unescape
+from bs4 import BeautifulSoup
+
+BASE_URL = "https://trustpilot.com"
+
+# Trustpilot pages embed all page data as JSON in a script tag, so the fast path
+# only needs to find that tag and the pagination link instead of building a DOM.
+JSON_SCRIPT_RE = re.compile(
+ rb'<script[^>]*type="application/json"[^>]*>(.*?)</script>', re.S)
+NEXT_PAGE_RE = re.compile(rb'<a[^>]*name="pagination-button-next"[^>]*>')
+HREF_RE = re.compile(rb'href="([^"]*)"')
+
+
+def parse_page(html, base_url=BASE_URL):
+	"""
+	Extract the application/json payload, its reviews and the next page url from a
+	page. Uses the regex based fast path and falls back to BeautifulSoup if the
+	page doesn't have the expected markup.
+	"""
+	try:
+		return parse_page_fast(html, base_url)
+	except (ValueError, KeyError, TypeError):
+		return parse_page_soup(html, base_url)
+
+
+def parse_page_fast(html, base_url=BASE_URL):
+	if isinstance(html, str):
+		html = html.encode()
+	match = JSON_SCRIPT_RE.search(html)
+	if match is None:
+		raise ValueError("No application/json script tag found")
+	payload = json.loads(match.group(1))
+
+	next_page_url = None
+	next_page = NEXT_PAGE_RE.search(html)
+	if next_page:
+		href = HREF_RE.search(next_page.group(0))
+		if href:
+			next_page_url = base_url + unescape(href.group(1).decode())
+
+	return dict(
+	 payload=payload,
+	 reviews=payload["props"]["pageProps"].get("reviews", []),
+	 next_page_url=next_page_url,
+	)
+
+
+def parse_page_soup(html, base_url=BASE_URL):
+	soup = BeautifulSoup(html, "html.parser")
+	payload = get_payload(soup)
+	return dict(
+	 payload=payload,
+	 reviews=payload["props"]["pageProps"].get("reviews", []) if payload else [],
+	 next_page_url=parse_next_page_url(soup, base_url),
+	)
+
+
+def parse_next_page_url(soup, base_url=BASE_URL):
+	next_page = soup.select('[name="pagination-button-next"]')
+	if next_page and "href" in next_page[0].attrs:
+		next_page_url = base_url + next_page[0].attrs["href"]
+	else:
+		next_page_url = None
+	return next_page_url
+
+
+def get_payload(soup):
+	"""The first application/json script tag holding the page data."""
+	js_data = soup.find(attrs={"type": "application/json"})
+	if js_data:
+		return json.loads(js_data.decode_contents())
+	else:
+		return {}
@@ -1,21 +1,30 @@
-import requests, json
-from bs4 import BeautifulSoup
+import requests
+from collections import Counter
+import argparse
+import asyncio
+import aiohttp
+import threading
+import multiprocessing
+from datetime import datetime
+from urllib.parse import urlparse
 from assistant.db import models, crud
-from assistant.llm import embed
-from time import sleep
+from assistant.llm import embed, EMBED_BATCH_SIZE
+from trustpilot_parsing import BASE_URL, parse_page
+from crawl_frontier import CrawlFrontier
+from time import sleep, monotonic
 
 
 def scrape_companies(max_pages_to_scrape=100):
+	fetch_counter.clear()
 	i = 0
 	url = "https://www.trustpilot.com/categories/real_estate_agents"
 	while url:
-		soup = get_soup(url)
+		page = fetch_page(url)
+		url = page["next_page_url"]
 
-		url = get_next_page_url(url)
-		js_data = soup.find_all(attrs={"type": "application/json"})[0]
-		js_json = json.loads(js_data.decode_contents())
-
-		for company in js_json["props"]["pageProps"]["newestBusinessUnits"]:
+		companies = page["payload"]["props"]["pageProps"]["newestBusinessUnits"]
+		embeddings = embed([company["displayName"] for company in companies])
+		for company, embedding in zip(companies, embeddings):
 			company = models.Company(
 			 name=company["displayName"],
 			 homepage=company["identifyingName"],
@@ -23,7 +32,7 @@ def scrape_companies(max_pages_to_scrape=100):
 			 trust_score=company["trustScore"],
 			 n_reviews=company["numberOfReviews"],
 			 country=company["location"]["country"],
-			 embedding=embed(company["displayName"])[0],
+			 embedding=embedding,
 			)
 			crud.company.upsert(company)
 			print(f"Company scraped: {company.name}")
@@ -33,87 +42,401 @@ def scrape_companies(max_pages_to_scrape=100):
 			break
 
 		sleep(20)
+	log_fetches("Companies crawl")
 
 
-def scrape_company_reviews(max_pages_to_scrape=40):
+def scrape_company_reviews(max_pages_to_scrape=40, incremental=False):
+	"""
+	Crawl reviews for all companies. With `incremental` a company's crawl stops at
+	the first page holding only reviews already seen in a previous crawl.
+	"""
+	fetch_counter.clear()
+	watermarks = crud.review.latest_timestamps() if incremental else {}
 	df_companies = crud.company.get_table()
 	for idx, company in df_companies.iterrows():
+		watermark = watermarks.get(company["id"])
 		try:
-			scrape_homepage_reviews(company, max_pages_to_scrape)
+			scrape_homepage_reviews(company, max_pages_to_scrape, watermark)
 			print(f"Homepage scraped: {company['homepage']}")
 		except Exception as e:
 			sleep(60)
 			try:
-				scrape_homepage_reviews(company, max_pages_to_scrape)
+				scrape_homepage_reviews(company, max_pages_to_scrape, watermark)
 				print(f"Homepage scraped: {company['homepage']}")
 			except:
 				print(f"Error: {company['homepage']}")
+	review_embedder.flush()
+	review_embedder.log()
+	log_fetches("Reviews crawl")
 
 
-def scrape_homepage_reviews(company, max_pages_to_scrape=40):
-	review_page_url = f"https://trustpilot.com/review/{company['homepage']}"
+def scrape_homepage_reviews(company, max_pages_to_scrape=40, watermark=None):
+	review_page_url = f"{BASE_URL}/review/{company['homepage']}"
 	for i in range(1, max_pages_to_scrape):
 		if review_page_url:
-			soup = get_soup(review_page_url)
-			reviews = get_reviews(soup)
-			if reviews:
-				dump_reviews2db(reviews, company)
+			page = fetch_page(review_page_url)
+			if page["reviews"]:
+				review_objs = dump_reviews2db(page["reviews"], company)
+				if is_behind_watermark(review_objs, watermark):
+					break
 			else:
 				break
 		else:
 			break
 
-		review_page_url = get_next_page_url(review_page_url)
+		review_page_url = page["next_page_url"]
 		sleep(20)
 
 
-def get_next_page_url(reviews_url):
-	soup = get_soup(reviews_url)
-	next_page = soup.select('[name="pagination-button-next"]')
-	next_page_attr = next_page[0].attrs
-	if "href" in next_page_attr:
-		next_page_url = f"https://trustpilot.com" + next_page_attr["href"]
-	else:
-		next_page_url = None
-	return next_page_url
+###   Page processing   ###
+# Number of fetches per url in the current crawl. A crawl fetching every page
+# exactly once has sum(fetch_counter.values()) == len(fetch_counter).
+fetch_counter = Counter()
+
+
+def log_fetches(name):
+	print(
+	 f"{name}: {sum(fetch_counter.values())} fetches of {len(fetch_counter)} pages"
+	)
 
 
-def get_soup(url):
+def fetch_page(url, base_url=BASE_URL):
+	"""Download a page once and extract everything the crawl needs from it."""
+	fetch_counter[url] += 1
 	html = requests.get(url)
-	return BeautifulSoup(html.content, "html.parser")
+	return parse_page(html.content, base_url)
+
+
+def dump_reviews2db(reviews, company):
+	review_objs = [
+	 models.Review(
+	  id=review["id"],
+	  company_id=company["id"],
+	  company=company["name"],
+	  rating=review["rating"],
+	  timestamp=review["dates"]["publishedDate"],
+	  content=review["text"],
+	  source="scraped",
+	  likes=review["likes"],
+	 ) for review in reviews
+	]
+	# One query for the whole page to find the reviews already in the db
+	db_timestamps = crud.review.timestamps([r.id for r in review_objs])
+	for review_obj in review_objs:
+		if db_timestamps.get(review_obj.id) == review_obj.timestamp.replace(
+		  tzinfo=None):
+			continue
+		else:
+			review_embedder.add(review_obj)
+	return review_objs
+
+
+def is_behind_watermark(review_objs, watermark):
+	"""True if all reviews are older than the newest review of the last crawl."""
+	if watermark is None:
+		return False
+	return all(r.timestamp.replace(tzinfo=None) <= watermark for r in review_objs)
+
+
+class ReviewEmbedder:
+	"""
+	Collects new or changed reviews across pages and companies and embeds them
+	`batch_size` at a time, so a crawl makes one embedding request per batch
+	instead of one per review. Each embedded batch is written to the db in a single
+	transaction with crud.review.upsert_many.
+	"""
+
+	def __init__(self, batch_size=EMBED_BATCH_SIZE["cohere"]):
+		self.batch_size = batch_size
+		self.pending = []
+		self.lock = threading.Lock()
+		self.n_batches = 0
+		self.n_reviews = 0
+
+	def add(self, review_obj):
+		with self.lock:
+			self.pending.append(review_obj)
+			if len(self.pending) < self.batch_size:
+				return
+			batch = self.pending[:self.batch_size]
+			self.pending = self.pending[self.batch_size:]
+		self.embed_and_write(batch)
+
+	def flush(self):
+		with self.lock:
+			batches = [
+			 self.pending[i:i + self.batch_size]
+			 for i in range(0, len(self.pending), self.batch_size)
+			]
+			self.pending = []
+		for batch in batches:
+			self.embed_and_write(batch)
 
+	def log(self):
+		print(f"Embedded {self.n_reviews} reviews in {self.n_batches} batches")
 
-def get_reviews(soup):
-	data = soup.find_all(attrs={"type": "application/json"})
-	if data:
-		js_data = soup.find_all(attrs={"type": "application/json"})[0]
-		js_json = json.loads(js_data.decode_contents())
-		return js_json["props"]["pageProps"]["reviews"]
+	def embed_and_write(self, review_objs):
+		embeddings = embed([review_obj.content for review_obj in review_objs])
+		for review_obj, embedding in zip(review_objs, embeddings):
+			review_obj.embedding = embedding
+		crud.review.upsert_many(review_objs)
+		with self.lock:
+			self.n_batches += 1
+			self.n_reviews += len(review_objs)
+
+
+review_embedder = ReviewEmbedder()
+
+
+###   Resumable crawl   ###
+def scrape_company_reviews_resumable(max_pages_to_scrape=40,
+                                     n_processes=4,
+                                     frontier_path=".cache/crawl_frontier.sqlite",
+                                     incremental=False,
+                                     restart=False,
+                                     delay=20):
+	"""
+	Crawl reviews with `n_processes` worker processes sharing a persistent crawl
+	frontier. Progress is checkpointed after every page, so a restarted crawl
+	continues where it stopped unless `restart` is set or the last crawl finished.
+	"""
+	frontier = CrawlFrontier(frontier_path)
+	if restart or frontier.is_finished():
+		companies = [company for _, company in crud.company.get_table().iterrows()]
+		watermarks = crud.review.latest_timestamps() if incremental else {}
+		frontier.seed(companies, watermarks, BASE_URL)
 	else:
-		return []
+		frontier.release_leases()
 
+	ctx = multiprocessing.get_context("spawn")
+	workers = [
+	 ctx.Process(target=frontier_worker,
+	             args=(frontier_path, max_pages_to_scrape, delay))
+	 for _ in range(n_processes)
+	]
+	for worker in workers:
+		worker.start()
+	for worker in workers:
+		worker.join()
+	print(f"Crawl frontier: {frontier.counts()}")
 
-def dump_reviews2db(reviews, company):
-	for review in reviews:
-		review_obj = models.Review(
-		 id=review["id"],
-		 company_id=company["id"],
-		 company_name=company["name"],
-		 rating=review["rating"],
-		 timestamp=review["dates"]["publishedDate"],
-		 content=review["text"],
-		 source="scraped",
-		 likes=review["likes"],
-		)
-		review_db = crud.review.get(review_obj.id)
-		if review_db is not None and (review_db.timestamp
-		                              == review_obj.timestamp.replace(tzinfo=None)):
+
+def frontier_worker(frontier_path, max_pages_to_scrape=40, delay=20):
+	frontier = CrawlFrontier(frontier_path)
+	while True:
+		item = frontier.lease()
+		if item is None:
+			if frontier.is_finished():
+				break
+			# Remaining items are leased by other workers or waiting on a retry
+			sleep(delay)
 			continue
+
+		try:
+			crawl_frontier_item(frontier, item, max_pages_to_scrape, delay)
+			frontier.done(item["company_id"])
+			print(f"Homepage scraped: {item['company']['homepage']}")
+		except Exception as e:
+			frontier.fail(item["company_id"], repr(e))
+			print(f"Error: {item['company']['homepage']} {e!r}")
+	review_embedder.log()
+	log_fetches("Reviews crawl worker")
+
+
+def crawl_frontier_item(frontier, item, max_pages_to_scrape=40, delay=20):
+	company = item["company"]
+	watermark = item["watermark"] and datetime.fromisoformat(item["watermark"])
+	review_page_url = item["next_page_url"]
+	pages = item["pages"]
+	while review_page_url and pages < max_pages_to_scrape:
+		page = fetch_page(review_page_url)
+		if page["reviews"]:
+			review_objs = dump_reviews2db(page["reviews"], company)
+			review_page_url = (None if is_behind_watermark(review_objs, watermark)
+			                   else page["next_page_url"])
+		else:
+			review_page_url = None
+
+		# Reviews must be in the db before the checkpoint moves past their page
+		review_embedder.flush()
+		frontier.checkpoint(item["company_id"], review_page_url)
+		pages += 1
+		sleep(delay)
+
+
+###   Async crawl   ###
+class TokenBucket:
+	"""Rate limiter allowing `rate` requests per second with bursts of up to `capacity`."""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.updated_at = monotonic()
+		self.lock = asyncio.Lock()
+
+	async def acquire(self):
+		async with self.lock:
+			while True:
+				now = monotonic()
+				self.tokens = min(self.capacity,
+				                  self.tokens + (now - self.updated_at) * self.rate)
+				self.updated_at = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostRateLimiter:
+	"""One token bucket per host, so every host is crawled at most at `rate`."""
+
+	def __init__(self, rate, capacity=1):
+		self.rate = rate
+		self.capacity = capacity
+		self.buckets = {}
+
+	async def acquire(self, url):
+		host = urlparse(url).netloc
+		if host not in self.buckets:
+			self.buckets[host] = TokenBucket(self.rate, self.capacity)
+		await self.buckets[host].acquire()
+
+
+def scrape_company_reviews_async(max_pages_to_scrape=40,
+                                 n_workers=8,
+                                 rate=0.5,
+                                 burst=1,
+                                 base_url=BASE_URL,
+                                 incremental=False):
+	"""
+	Crawl reviews for all companies with `n_workers` concurrent workers sharing a
+	pooled HTTP session. Throughput is bounded by the per host rate limit of `rate`
+	requests per second instead of a fixed sleep between pages.
+	"""
+	companies = [company for _, company in crud.company.get_table().iterrows()]
+	watermarks = crud.review.latest_timestamps() if incremental else {}
+	asyncio.run(
+	 crawl_companies(companies, max_pages_to_scrape, n_workers, rate, burst,
+	                 base_url, watermarks))
+
+
+async def crawl_companies(companies,
+                          max_pages_to_scrape=40,
+                          n_workers=8,
+                          rate=0.5,
+                          burst=1,
+                          base_url=BASE_URL,
+                          watermarks={}):
+	fetch_counter.clear()
+	queue = asyncio.Queue()
+	for company in companies:
+		queue.put_nowait(company)
+
+	limiter = HostRateLimiter(rate, burst)
+	connector = aiohttp.TCPConnector(limit=n_workers)
+	async with aiohttp.ClientSession(connector=connector) as session:
+		workers = [
+		 asyncio.create_task(
+		  crawl_worker(queue, session, limiter, max_pages_to_scrape, base_url,
+		               watermarks))
+		 for _ in range(n_workers)
+		]
+		await queue.join()
+		for worker in workers:
+			worker.cancel()
+		await asyncio.gather(*workers, return_exceptions=True)
+	review_embedder.flush()
+	review_embedder.log()
+	log_fetches("Reviews crawl")
+
+
+async def crawl_worker(queue, session, limiter, max_pages_to_scrape, base_url,
+                       watermarks):
+	while True:
+		company = await queue.get()
+		watermark = watermarks.get(company["id"])
+		try:
+			await scrape_homepage_reviews_async(company, session, limiter,
+			                                    max_pages_to_scrape, base_url,
+			                                    watermark)
+			print(f"Homepage scraped: {company['homepage']}")
+		except Exception as e:
+			await asyncio.sleep(60)
+			try:
+				await scrape_homepage_reviews_async(company, session, limiter,
+				                                    max_pages_to_scrape, base_url,
+				                                    watermark)
+				print(f"Homepage scraped: {company['homepage']}")
+			except:
+				print(f"Error: {company['homepage']}")
+		finally:
+			queue.task_done()
+
+
+async def scrape_homepage_reviews_async(company,
+                                        session,
+                                        limiter,
+                                        max_pages_to_scrape=40,
+                                        base_url=BASE_URL,
+                                        watermark=None):
+	review_page_url = f"{base_url}/review/{company['homepage']}"
+	for i in range(1, max_pages_to_scrape):
+		if not review_page_url:
+			break
+
+		page = await fetch_page_async(session, review_page_url, limiter, base_url)
+		if page["reviews"]:
+			# Embedding and db writes are blocking, so keep them off the event loop
+			review_objs = await asyncio.to_thread(dump_reviews2db, page["reviews"],
+			                                      company)
+			if is_behind_watermark(review_objs, watermark):
+				break
 		else:
-			review_obj.embedding = embed(review_obj.content)[0]
-			crud.review.upsert(review_obj)
+			break
+
+		review_page_url = page["next_page_url"]
+
+
+async def fetch_page_async(session, url, limiter, base_url=BASE_URL):
+	await limiter.acquire(url)
+	fetch_counter[url] += 1
+	async with session.get(url) as response:
+		response.raise_for_status()
+		html = await response.read()
+	return await asyncio.to_thread(parse_page, html, base_url)
 
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser()
+	parser.add_argument("--workers",
+	                    type=int,
+	                    default=0,
+	                    help="Crawl reviews with n concurrent asyncio workers")
+	parser.add_argument("--rate",
+	                    type=float,
+	                    default=0.5,
+	                    help="Max requests per second per host for --workers")
+	parser.add_argument("--processes",
+	                    type=int,
+	                    default=0,
+	                    help="Crawl reviews with n processes from a resumable frontier")
+	parser.add_argument("--restart",
+	                    action="store_true",
+	                    help="Start a new crawl instead of resuming with --processes")
+	parser.add_argument("--incremental",
+	                    action="store_true",
+	                    help="Only crawl reviews newer than the last crawl")
+	args = parser.parse_args()
+
 	scrape_companies()
-	scrape_company_reviews()
+	if args.processes:
+		scrape_company_reviews_resumable(n_processes=args.processes,
+		                                 incremental=args.incremental,
+		                                 restart=args.restart)
+	elif args.workers:
+		scrape_company_reviews_async(n_workers=args.workers,
+		                             rate=args.rate,
+		                             incremental=args.incremental)
+	else:
+		scrape_company_reviews(incremental=args.incremental)